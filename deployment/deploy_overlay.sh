@@ -15,6 +15,7 @@ WWW_SERVICE=apache2
 
 cp -vr simplestore/lib/* /opt/invenio/lib/python/invenio/
 cp -vr simplestore/etc/static/* /opt/invenio/var/www/
+cp -v simplestore/bin/* /opt/invenio/bin/
 cp -vr simplestore/etc/templates/*.html /opt/invenio/etc/templates/
 cp -vr simplestore/etc/templates/*.markdown /opt/invenio/etc/templates/
 
@@ -83,7 +83,12 @@ from invenio.errorlib import register_exception
 from invenio.bibcatalog import bibcatalog_system
 from invenio.intbitset import intbitset
 from invenio.urlutils import make_user_agent_string
-from invenio.config import CFG_BIBDOCFILE_FILEDIR
+from invenio.simplestore_recid import new_recid, peek_recid
+from invenio.config import CFG_BIBDOCFILE_FILEDIR, CFG_TMPSHAREDDIR
+try:
+    from invenio.config import CFG_BIBUPLOAD_FFT_ALLOWED_LOCAL_PATHS
+except ImportError:
+    CFG_BIBUPLOAD_FFT_ALLOWED_LOCAL_PATHS = []
 from invenio.bibtask import task_init, write_message, \
     task_set_option, task_get_option, task_get_task_param, task_update_status, \
     task_update_progress, task_sleep_now_if_required, fix_argv_paths
@@ -766,6 +771,30 @@ def print_out_bibupload_statistics():
               'nb_sec': time.time() - time.mktime(stat['exectime']) }
     write_message(out)
 
+def download_or_link_url(url, docformat):
+    """
+    Same as download_url, but a local file from one of the allowed FFT
+    paths is hard linked into the temporary directory instead of being
+    copied, which takes no time whatever its size. Falls back to
+    download_url whenever linking is not possible (e.g. the file is on
+    another file system).
+    """
+    if os.path.isabs(url) and os.path.isfile(url):
+        path = os.path.realpath(url)
+        if [allowed for allowed in CFG_BIBUPLOAD_FFT_ALLOWED_LOCAL_PATHS
+            if path.startswith(os.path.realpath(allowed) + os.sep)]:
+            tmpfd, tmppath = tempfile.mkstemp(suffix=docformat,
+                                              prefix="bibupload_",
+                                              dir=CFG_TMPSHAREDDIR)
+            os.close(tmpfd)
+            try:
+                os.link(path, tmppath + '.lnk')
+                os.rename(tmppath + '.lnk', tmppath)
+                return tmppath
+            except OSError:
+                os.remove(tmppath)
+    return download_url(url, docformat)
+
 def open_marc_file(path):
     """Open a file and return the data"""
     try:
@@ -1203,11 +1232,13 @@ def create_new_record(rec_id=None, pretend=False):
         if rec_id:
             return rec_id
         else:
-            return run_sql("SELECT max(id)+1 FROM bibrec")[0][0]
+            # ids are reserved in blocks, max(id)+1 may be taken already
+            return peek_recid()
     if rec_id is not None:
         return run_sql("INSERT INTO bibrec (id, creation_date, modification_date) VALUES (%s, NOW(), NOW())", (rec_id, ))
     else:
-        return run_sql("INSERT INTO bibrec (creation_date, modification_date) VALUES (NOW(), NOW())")
+        # ids are reserved in blocks, the row of this one exists already
+        return new_recid()
 
 def insert_bibfmt(id_bibrec, marc, bibformat, modification_date='1970-01-01 00:00:00', pretend=False):
     """Insert the format in the table bibfmt"""
@@ -1967,7 +1998,7 @@ def elaborate_fft_tags(record, rec_id, mode, pretend=False,
             for url, docformat, description, comment, flags, timestamp in urls:
                 if url:
                     try:
-                        downloaded_url = download_url(url, docformat)
+                        downloaded_url = download_or_link_url(url, docformat)
                         write_message("%s saved into %s" % (url, downloaded_url), verbose=9)
                     except Exception, err:
                         write_message("Error in downloading '%s' because of: %s" % (url, err), stream=sys.stderr)
@@ -23,12 +23,13 @@ $(document).ready(function() {
     /**
      * Handle clicking on deposit button.
      *
-     * Either return success page or errors with form.
+     * Either return success page or mark the errors in the form.
      */
     function deposit_click_handler(e) {
         e.preventDefault();
         $('#deposit').addClass('disabled');
-        $.post("addmeta/" + $('#sub_id').val(), $("#metaform_form").serialize(),
+        $.post("addmeta/" + $('#sub_id').val() + "?errors_only=1",
+            $("#metaform_form").serialize(),
             function(data) {
                 if (data.valid) {
                     //Load new page with success message
@@ -37,14 +38,88 @@ $(document).ready(function() {
                     newDoc.close();
 
                 } else {
-                    //Just replace metadata form with errors
-                    $('#meta-fields').html(data.html);
+                    //Just mark the errors in the metadata form
+                    $('#meta-fields .field-errors').remove();
+                    $('#meta-fields tr.error').removeClass('error');
+                    $('#form-errors').empty().addClass('hide');
+                    //an expired CSRF token comes with a new one, so that
+                    //the form can simply be sent again
+                    if (data.csrf_token) {
+                        $('#meta-fields [name="csrf_token"]').val(data.csrf_token);
+                    }
+                    $.each(data.errors, show_field_errors);
                     $('#deposit').removeClass('disabled');
                 }
 
             }, "json");
     }
 
+    /**
+     * Mark a field of the metadata form as valid or not.
+     *
+     * messages is the list of errors of the field, empty if it is valid.
+     * Errors of hidden fields, such as the CSRF token, are shown above the
+     * deposit button.
+     */
+    function show_field_errors(name, messages) {
+        var input = $('#meta-fields [name="' + name + '"]');
+        var cell = input.closest('td');
+        if (!cell.length) {
+            show_form_errors(messages);
+            return;
+        }
+        cell.find('.field-errors').remove();
+        input.closest('tr').toggleClass('error', messages.length > 0);
+        $.each(messages, function(i, message) {
+            $('<p class="help-block text-error field-errors"/>')
+                .text(message).appendTo(cell);
+        });
+    }
+
+    /**
+     * Show errors which concern the metadata form as a whole.
+     */
+    function show_form_errors(messages) {
+        var box = $('#form-errors');
+        $.each(messages, function(i, message) {
+            $('<p/>').text(message).appendTo(box);
+        });
+        box.toggleClass('hide', box.is(':empty'));
+    }
+
+    /**
+     * Validate a field of the metadata form on the server.
+     *
+     * Only the errors of the field are returned, so that they can be shown
+     * while the form is filled in rather than once it is submitted.
+     */
+    function validate_field() {
+        var input = $(this);
+        var domain = $('#domains input:radio:checked').val();
+        var name = input.attr('name');
+        if (!domain || !name || name == 'csrf_token') {
+            return;
+        }
+        var params = {};
+        params[name] = input.is(':checkbox') && !input.is(':checked') ?
+            '' : input.val();
+        // relative to the deposit page, wherever the blueprint is mounted
+        $.post("validate/" + domain, params, function(data) {
+            show_field_errors(name, data.errors[name] || []);
+        }, "json");
+    }
+
+    var validate_timer = null;
+    $('#meta-fields').on('change blur', 'input, select, textarea',
+                         validate_field);
+    $('#meta-fields').on('keyup', 'input, textarea', function() {
+        var input = this;
+        clearTimeout(validate_timer);
+        validate_timer = setTimeout(function() {
+            validate_field.call(input);
+        }, 500);
+    });
+
     /**
      * Handle clicking on domain.
      *
@@ -81,17 +156,50 @@ $(document).ready(function() {
 
     $('#deposit').click(deposit_click_handler);
 
+    /**
+     * Set up typeahead fields with a remote source on first focus.
+     *
+     * Their values are not in the form but fetched from the URL in
+     * data-remote as the user types.
+     */
+    $(document).on('focus', 'input[data-provide="typeahead-remote"]', function() {
+        var input = $(this);
+        if (input.data('typeahead')) {
+            return;
+        }
+        input.typeahead({
+            // the values are passed to process once they have arrived;
+            // returning anything would make them be taken at once
+            source: function(query, process) {
+                $.getJSON(input.data('remote'), {q: query},
+                    function(data) {
+                        process(data.values);
+                    });
+            }
+        });
+    });
+
 });
 
 //removed db_files for simplicity - add restarting later if reqd
-function simplestore_init_plupload(selector, url, delete_url, get_file_url) {
+function simplestore_init_plupload(selector, url, delete_url, get_file_url,
+                                   status_url, raw_url, chunk_size,
+                                   max_chunk_size, chunk_size_url) {
+
+        chunk_size = chunk_size || 1024 * 1024;
+        max_chunk_size = max_chunk_size || chunk_size;
 
         uploader = new plupload.Uploader({
                 // General settings
                 runtimes : 'html5',
-                url : url,
+                // with a raw upload url, chunks are sent as the request body
+                // and written to disk without a multipart form in between
+                url : raw_url || url,
+                multipart : !raw_url,
                 max_file_size : '2048mb',
-                chunk_size : '1mb',
+                chunk_size : chunk_size,
+                // transient failures are retried, where the runtime supports it
+                max_retries : 3,
                 //unique_names : true,
                 browse_button : 'pickfiles',
                 drop_element : 'filebox'
@@ -133,12 +241,14 @@ function simplestore_init_plupload(selector, url, delete_url, get_file_url) {
                 $.each(files, function(i, file) {
                         $('#filelist #' + file.id).hide('fast');
                         if (file.loaded == file.size) {
-                                $.ajax({
-                                        type: "POST",
-                                        url: delete_url,
-                                        data: $.param({
-                                                filename: file.unique_filename
-                                        })
+                                $.each(file.unique_filenames || [], function(j, filename) {
+                                        $.ajax({
+                                                type: "POST",
+                                                url: delete_url,
+                                                data: $.param({
+                                                        filename: filename
+                                                })
+                                        });
                                 });
                         }
                 });
@@ -156,6 +266,86 @@ function simplestore_init_plupload(selector, url, delete_url, get_file_url) {
                 console.log("Progress " + file.name + " - " + file.percent);
         });
 
+        // let the server write every chunk straight to its offset
+        function set_chunk_size(file, file_chunk_size) {
+                uploader.settings.chunk_size = file_chunk_size;
+                uploader.settings.multipart_params = {
+                        chunk_size: file_chunk_size,
+                        total_size: file.size,
+                        extract: $('#extract_archives').is(':checked') ? 1 : 0
+                };
+        }
+
+        // starts the upload of a file held back by BeforeUpload, unless
+        // the uploader has been stopped meanwhile
+        function start_upload(up, file, file_chunk_size) {
+                set_chunk_size(file, file_chunk_size);
+                if (up.state == plupload.STARTED) {
+                        up.trigger('UploadFile', file);
+                } else {
+                        file.status = plupload.QUEUED;
+                }
+        }
+
+        // the chunk size of a file may have to be asked from the server
+        // first; the upload is then held back and started once the answer
+        // has come, without blocking the page in the meantime
+        uploader.bind('BeforeUpload', function(up, file) {
+                if (file.loaded > 0 && status_url) {
+                        // an interrupted upload is resumed after the last
+                        // chunk the server has received, with the same
+                        // chunk size
+                        $.ajax({
+                                url: status_url,
+                                data: {name: file.name},
+                                dataType: 'json',
+                                success: function(status) {
+                                        file.loaded = status.resume_offset;
+                                        start_upload(up, file,
+                                                     status.chunk_size || chunk_size);
+                                },
+                                error: function() {
+                                        start_upload(up, file, chunk_size);
+                                }
+                        });
+                        return false;
+                }
+                if (file.size > chunk_size && chunk_size_url) {
+                        // the server knows how fast uploads have been so far
+                        $.ajax({
+                                url: chunk_size_url,
+                                data: {size: file.size},
+                                dataType: 'json',
+                                success: function(data) {
+                                        start_upload(up, file,
+                                                     Math.min(data.chunk_size,
+                                                              max_chunk_size));
+                                },
+                                error: function() {
+                                        start_upload(up, file, chunk_size);
+                                }
+                        });
+                        return false;
+                }
+                set_chunk_size(file, chunk_size);
+        });
+
+        // the server answers 429 when too many uploads are in progress;
+        // the file is queued again and resumed once the server says so
+        uploader.bind('Error', function(up, err) {
+                if (err.status != 429 || !err.file)
+                        return;
+                var retry_after = 2;
+                try {
+                        retry_after = $.parseJSON(err.response).retry_after;
+                } catch (e) {}
+                setTimeout(function() {
+                        err.file.status = plupload.QUEUED;
+                        if (up.state == plupload.STOPPED)
+                                up.start();
+                }, retry_after * 1000);
+        });
+
         uploader.bind('UploadFile', function(up, file) {
                 $('#' + file.id + "_rm").hide();
         });
@@ -184,8 +374,18 @@ function simplestore_init_plupload(selector, url, delete_url, get_file_url) {
                 $('#' + file.id + " .progress").removeClass("progress-striped");
                 $('#' + file.id + " .bar").css('width', "100%");
                 $('#' + file.id + '_rm').show();
-                $('#' + file.id + '_link').html('<a href="' + get_file_url + "?filename=" + responseObj.response + '">' + file.name + '</a>');
-                file.unique_filename = responseObj.response;
+                // an unpacked archive is answered with the names of its files
+                var extracted = null;
+                try {
+                        extracted = $.parseJSON(responseObj.response).files;
+                } catch (err) {}
+                if (extracted) {
+                        $('#' + file.id + '_link').html(file.name + ' (' + extracted.length + ' files unpacked)');
+                        file.unique_filenames = extracted;
+                } else {
+                        $('#' + file.id + '_link').html('<a href="' + get_file_url + "?filename=" + responseObj.response + '">' + file.name + '</a>');
+                        file.unique_filenames = [responseObj.response];
+                }
                 if (uploader.total.queued === 0)
                         $('#stopupload').hide();
 
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Archive Extraction
+
+Reads the regular files out of zip and tar archives one at a time, so that
+the upload handler can store each of them as a file of the submission.
+Members are decompressed while they are read, and only once; tar archives,
+compressed or not, are read as a stream and need not be on disk at all.
+Directories, links, devices and encrypted members are skipped.
+
+The number of files and the total size of the data extracted from one
+archive are limited, whatever the archive claims about its members.
+"""
+import stat
+import zlib
+import tarfile
+import zipfile
+
+# If CFG_SIMPLESTORE_EXTRACT_MAX_SIZE is not found in invenio-local.conf,
+# default is to extract at most 10 GB from an archive
+try:
+    from invenio.config import CFG_SIMPLESTORE_EXTRACT_MAX_SIZE
+except ImportError:
+    CFG_SIMPLESTORE_EXTRACT_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# If CFG_SIMPLESTORE_EXTRACT_MAX_FILES is not found in invenio-local.conf,
+# default is to extract at most 10000 files from an archive
+try:
+    from invenio.config import CFG_SIMPLESTORE_EXTRACT_MAX_FILES
+except ImportError:
+    CFG_SIMPLESTORE_EXTRACT_MAX_FILES = 10000
+
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tbz2')
+
+
+class ArchiveError(Exception):
+    """ The archive is broken or exceeds the extraction limits """
+    pass
+
+
+def is_zip(name):
+    """ Returns True if name is the name of a zip archive """
+    return name.lower().endswith(ZIP_EXTENSIONS)
+
+
+def is_tar(name):
+    """ Returns True if name is the name of a (compressed) tar archive """
+    return name.lower().endswith(TAR_EXTENSIONS)
+
+
+def is_archive(name):
+    """ Returns True if name is the name of an archive we can extract """
+    return is_zip(name) or is_tar(name)
+
+
+class _LimitedReader(object):
+    """
+    File object reading an archive member, which charges the bytes read
+    to the limits shared by all members of the archive.
+    """
+
+    def __init__(self, member, limits):
+        self.member = member
+        self.limits = limits
+
+    def read(self, size=-1):
+        try:
+            data = self.member.read(size)
+        except (zlib.error, zipfile.BadZipfile, tarfile.TarError,
+                EOFError) as e:
+            raise ArchiveError(str(e))
+        self.limits['size'] -= len(data)
+        if self.limits['size'] < 0:
+            raise ArchiveError("Archive exceeds %d bytes"
+                               % CFG_SIMPLESTORE_EXTRACT_MAX_SIZE)
+        return data
+
+
+def _iter_zip(fileobj):
+    """ Yields the name and file object of the regular files of a zip """
+    try:
+        archive = zipfile.ZipFile(fileobj)
+        for info in archive.infolist():
+            mode = info.external_attr >> 16
+            if (info.filename.endswith('/') or info.flag_bits & 0x1 or
+                    (stat.S_IFMT(mode) and not stat.S_ISREG(mode))):
+                continue
+            yield info.filename, archive.open(info)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+        raise ArchiveError(str(e))
+
+
+def _iter_tar(fileobj):
+    """
+    Yields the name and file object of the regular files of a tar, which
+    is read as a stream.
+    """
+    try:
+        archive = tarfile.open(fileobj=fileobj, mode='r|*')
+        for info in archive:
+            if info.isfile():
+                yield info.name, archive.extractfile(info)
+    except (tarfile.TarError, zlib.error, EOFError, IOError) as e:
+        raise ArchiveError(str(e))
+
+
+def iter_members(fileobj, name):
+    """
+    Yields a tuple of the path in the archive and a file object for every
+    regular file of the archive fileobj, named name. Every member has to be
+    read before the next one is asked for. Zip archives must be seekable.
+
+    Raises ArchiveError if the archive is broken or exceeds the limits.
+    """
+    limits = dict(size=CFG_SIMPLESTORE_EXTRACT_MAX_SIZE,
+                  files=CFG_SIMPLESTORE_EXTRACT_MAX_FILES)
+    if is_zip(name):
+        members = _iter_zip(fileobj)
+    elif is_tar(name):
+        members = _iter_tar(fileobj)
+    else:
+        raise ArchiveError("%s is not an archive" % name)
+    for path, member in members:
+        limits['files'] -= 1
+        if limits['files'] < 0:
+            raise ArchiveError("Archive has more than %d files"
+                               % CFG_SIMPLESTORE_EXTRACT_MAX_FILES)
+        yield path, _LimitedReader(member, limits)
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Batch Deposit
+
+Deposits many submissions at once, e.g. for bulk imports. The records of
+all submissions go into one MARCXML collection, which is handed to a
+single bibupload task, instead of starting a task per record.
+
+A batch is a list of submissions, each a dictionary with the 'sub_id' of
+a submission whose files have been uploaded and its 'metadata', the values
+of the fields of the deposit form, including the 'domain':
+
+    {"submissions": [{"sub_id": "...",
+                      "metadata": {"domain": "generic", "title": "...",
+                                   "open_access": true, ...}}, ...]}
+
+Batches are posted to /deposit/batch, or given to the command
+simplestore_batch_deposit, whose submissions can also list local 'files'
+to deposit instead of a 'sub_id'. Every submission is validated with the
+form of its domain; invalid ones are reported and left out, the others
+are deposited. The progress of each submission is recorded in its
+manifest as for a single deposit.
+
+A posted batch is deposited by the finalization workers, as creating the
+records involves the PID service. The request is answered with the job
+and status URL of every valid submission; once the batch has been handed
+to bibupload, the status of each of its jobs has the same task_id. The
+command deposits its batches before it returns.
+"""
+import os
+import sys
+import uuid
+import optparse
+
+from flask import current_app, jsonify, url_for
+from werkzeug.datastructures import MultiDict
+
+from invenio.config import CFG_SITE_SECURE_URL
+from invenio.jsonutils import json
+from invenio.webuser_flask import current_user
+from invenio.simplestore_upload_handler import get_upload_dir, \
+    list_uploaded_files, import_file, SUB_ID_RE
+from invenio.simplestore_deposit_handler import get_form_class
+import invenio.simplestore_finalize as finalize
+import invenio.simplestore_marc_handler as mh
+import invenio.simplestore_manifest as manifest
+import invenio.simplestore_spool as spool
+
+# If CFG_SIMPLESTORE_BATCH_MAX_SIZE is not found in invenio-local.conf,
+# default is to accept at most 1000 submissions per request. The command
+# line is not limited
+try:
+    from invenio.config import CFG_SIMPLESTORE_BATCH_MAX_SIZE
+except ImportError:
+    CFG_SIMPLESTORE_BATCH_MAX_SIZE = 1000
+
+
+def submission_form(metadata):
+    """
+    Returns the metadata of a submission as the deposit form would post it,
+    and the errors found by the form of its domain, by field.
+    """
+    values = MultiDict()
+    for key, value in metadata.items():
+        # unchecked boxes are left out of a form
+        if value is None or value is False:
+            continue
+        if value is True:
+            value = u'y'
+        values[key] = unicode(value)
+    meta_class, MetaForm = get_form_class(values.get('domain', u'').lower())
+    form = MetaForm(values, meta_class(), csrf_enabled=False)
+    if not form.validate():
+        return values, form.errors
+    # the record is created from the form data, which has all text fields
+    for field in form:
+        if field.name not in values and not isinstance(field.data, bool):
+            values[field.name] = u''
+    return values, {}
+
+
+def _check_submission(sub_id):
+    """
+    Returns the upload directory of submission sub_id, or an error message
+    if there is no such submission or nothing has been uploaded for it.
+    """
+    if not isinstance(sub_id, basestring) or not SUB_ID_RE.match(sub_id):
+        return None, "Invalid submission id"
+    upload_dir = get_upload_dir(sub_id)
+    if not os.path.isdir(upload_dir) or not list_uploaded_files(upload_dir):
+        return None, "Uploads not found"
+    return upload_dir, None
+
+
+def prepare_batch(submissions):
+    """
+    Validates the submissions of the list and starts the finalization job
+    of each valid one.
+
+    Returns a list with the result of every submission, a dictionary with
+    its sub_id and, if it has been left out, the field 'errors' of its
+    metadata or an 'error' message, and the list of the jobs started, as
+    tuples of the sub_id and the form data of the submission.
+    """
+    results = []
+    jobs = []
+    for submission in submissions:
+        sub_id = submission.get('sub_id')
+        result = dict(sub_id=sub_id)
+        results.append(result)
+        upload_dir, error = _check_submission(sub_id)
+        if error is not None:
+            result['error'] = error
+            continue
+        values, errors = submission_form(submission.get('metadata') or {})
+        if errors:
+            result['errors'] = errors
+            continue
+        if not manifest.start_job(upload_dir, sub_id,
+                                  finalize.CFG_SIMPLESTORE_FINALIZE_TIMEOUT):
+            result['error'] = "Submission has already been deposited"
+            continue
+        jobs.append((sub_id, values))
+    return results, jobs
+
+
+def run_batch(app, jobs, email):
+    """
+    Creates the records of the jobs started by prepare_batch, deposited by
+    email, and submits them to bibupload in one task. The progress of
+    every job is recorded in the manifest of its submission.
+
+    Returns a tuple of the id of the bibupload task, or None if no record
+    was created, and a dictionary with the outcome of every job by sub_id:
+    the recid of its record, or an 'error' message.
+    """
+    outcomes = {}
+    deposited = []
+    records = []
+    with app.app_context():
+        for sub_id, values in jobs:
+            upload_dir = get_upload_dir(sub_id)
+
+            def progress(stage, **fields):
+                manifest.update_job(upload_dir, stage, **fields)
+
+            try:
+                recid, marc = mh.create_marc(values, sub_id, email, progress)
+            except Exception as e:
+                app.logger.exception("Deposit of %s failed" % sub_id)
+                error = str(e) or e.__class__.__name__
+                outcomes[sub_id] = dict(error=error)
+                _update_job(app, sub_id, upload_dir, 'failed',
+                            state='failed', error=error)
+                continue
+            # the record waits for the others of the batch
+            progress('spooled', recid=recid,
+                     url='%s/record/%s' % (CFG_SITE_SECURE_URL, recid))
+            outcomes[sub_id] = dict(recid=recid)
+            deposited.append((sub_id, upload_dir))
+            records.append(marc)
+
+        if not records:
+            return None, outcomes
+        # the batch is submitted on its own, it needs no spooling
+        try:
+            task_id = spool.submit(records)
+        except Exception as e:
+            app.logger.exception("Submission of the batch failed")
+            error = str(e) or e.__class__.__name__
+            for sub_id, upload_dir in deposited:
+                outcomes[sub_id] = dict(error=error)
+                _update_job(app, sub_id, upload_dir, 'failed',
+                            state='failed', error=error)
+            return None, outcomes
+        # the janitor keeps the uploads until bibupload had time to run
+        for sub_id, upload_dir in deposited:
+            _update_job(app, sub_id, upload_dir, 'done', state='submitted',
+                        task_id=task_id)
+        return task_id, outcomes
+
+
+def _update_job(app, sub_id, upload_dir, stage, **fields):
+    """
+    Records the stage of the job of submission sub_id, logging rather than
+    raising errors, so that the other jobs of the batch are recorded too.
+    """
+    try:
+        manifest.update_job(upload_dir, stage, **fields)
+    except Exception:
+        # e.g. the submission has been removed meanwhile
+        app.logger.exception("Cannot record the %s stage of %s" %
+                             (stage, sub_id))
+
+
+def deposit_batch(submissions, email):
+    """
+    Deposits the valid submissions of the list, deposited by email, with
+    one bibupload task, and returns when done.
+
+    Returns a tuple of the id of the bibupload task, or None if no record
+    was created, and a list with the result of every submission: a
+    dictionary with the sub_id and the recid of its record, or the field
+    'errors' of its metadata, or an 'error' message.
+    """
+    results, jobs = prepare_batch(submissions)
+    task_id, outcomes = run_batch(current_app._get_current_object(), jobs,
+                                  email)
+    for result in results:
+        if 'error' not in result and 'errors' not in result:
+            result.update(outcomes[result['sub_id']])
+    return task_id, results
+
+
+def batch_deposit(request):
+    """
+    Starts the deposit of the batch of submissions posted as JSON by the
+    current user. Returns the result of every submission: its job and the
+    URL of its status, or the reason it has been left out.
+    """
+    batch = request.json
+    submissions = batch.get('submissions') if isinstance(batch, dict) else None
+    if not isinstance(submissions, list) or \
+            not all(isinstance(s, dict) for s in submissions):
+        rv = jsonify(error="Expected a JSON object with a list of submissions")
+        rv.status_code = 400
+        return rv
+    if len(submissions) > CFG_SIMPLESTORE_BATCH_MAX_SIZE:
+        rv = jsonify(error="At most %d submissions can be deposited at once"
+                           % CFG_SIMPLESTORE_BATCH_MAX_SIZE)
+        rv.status_code = 413
+        return rv
+    results, jobs = prepare_batch(submissions)
+    if jobs:
+        finalize.enqueue(run_batch, current_app._get_current_object(), jobs,
+                         current_user['email'])
+    for result in results:
+        if 'error' not in result and 'errors' not in result:
+            result.update(job=result['sub_id'],
+                          status_url=url_for('.check_status',
+                                             sub_id=result['sub_id']))
+    return jsonify(submissions=results)
+
+
+def _import_submission(submission):
+    """
+    Stores the local files listed by a submission of the command line in
+    a new submission, and returns the submission with its sub_id.
+    """
+    if submission.get('sub_id') or not submission.get('files'):
+        return submission
+    sub_id = uuid.uuid1().hex
+    for path in submission['files']:
+        import_file(sub_id, path)
+    return dict(submission, sub_id=sub_id)
+
+
+def main():
+    """ Deposits the batches in the files given on the command line """
+    parser = optparse.OptionParser(
+        usage="%prog --email=EMAIL FILE...",
+        description="Deposit the submissions listed in the JSON files with "
+                    "a single bibupload task. Submissions may list local "
+                    "'files' to deposit instead of a 'sub_id'.")
+    parser.add_option('-e', '--email',
+                      help="email of the depositor, who can access "
+                           "restricted records")
+    options, args = parser.parse_args()
+    if not options.email or not args:
+        parser.error("an email and at least one file are required")
+
+    submissions = []
+    for path in args:
+        with open(path, 'rb') as fp:
+            batch = json.load(fp)
+        if isinstance(batch, dict):
+            batch = batch.get('submissions', [])
+        submissions.extend(_import_submission(s) for s in batch)
+
+    task_id, results = deposit_batch(submissions, options.email)
+    failed = 0
+    for result in results:
+        if 'recid' in result:
+            print "%s: record %s" % (result['sub_id'], result['recid'])
+        else:
+            failed += 1
+            print "%s: %s" % (result['sub_id'],
+                              result.get('error') or result.get('errors'))
+    if task_id is not None:
+        print "Submitted %d records as bibupload task #%s" % (
+            len(results) - failed, task_id)
+    if failed:
+        sys.exit(1)
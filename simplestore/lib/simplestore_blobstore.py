@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Blob Store
+
+Optional content-addressed store for uploaded files. Every distinct content
+is kept once, under its SHA-256, and uploads are hard links to it. The link
+count of a blob is therefore its reference count: a blob with a single link
+is not used by any submission any more and can be removed.
+
+The store is enabled by setting CFG_SIMPLESTORE_BLOB_FOLDER in
+invenio-local.conf to a directory on the same file system as
+CFG_SIMPLESTORE_UPLOAD_FOLDER.
+"""
+import os
+import errno
+
+from flask import current_app
+
+# If CFG_SIMPLESTORE_BLOB_FOLDER is not found in invenio-local.conf,
+# default is to store every upload separately
+try:
+    from invenio.config import CFG_SIMPLESTORE_BLOB_FOLDER
+except ImportError:
+    CFG_SIMPLESTORE_BLOB_FOLDER = None
+
+
+def is_enabled():
+    """ Returns True if the blob store is configured """
+    return bool(CFG_SIMPLESTORE_BLOB_FOLDER)
+
+
+def blob_path(sha256):
+    """ Returns the path of the blob with the given SHA-256 hex digest """
+    return os.path.join(CFG_SIMPLESTORE_BLOB_FOLDER,
+                        sha256[:2], sha256[2:4], sha256)
+
+
+def find_blob(sha256, size):
+    """
+    Returns the path of the blob with the given SHA-256 hex digest and size,
+    or None if the store does not hold such content.
+    """
+    if not is_enabled():
+        return None
+    path = blob_path(sha256)
+    try:
+        if os.path.getsize(path) == size:
+            return path
+    except OSError:
+        pass
+    return None
+
+
+def link_blob(blob, file_path):
+    """ Atomically makes file_path a hard link to blob """
+    tmp_path = file_path + '.link'
+    os.link(blob, tmp_path)
+    os.rename(tmp_path, file_path)
+
+
+def store(file_path, sha256):
+    """
+    Adds the uploaded file at file_path to the store. New content becomes a
+    blob sharing the inode of the upload; content that is stored already
+    replaces the upload with a link to the existing blob, so the duplicate
+    is freed.
+
+    Returns True if the upload was a duplicate. Any failure, e.g. the
+    store being on another file system, leaves the upload untouched.
+    """
+    if not is_enabled():
+        return False
+    blob = blob_path(sha256)
+    try:
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(file_path, blob)
+            # blobs are shared, nobody may change them in place
+            os.chmod(blob, 0444)
+            return False
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if os.path.getsize(blob) != os.path.getsize(file_path):
+            current_app.logger.error(
+                "Blob %s does not match the size of %s" % (blob, file_path))
+            return False
+        link_blob(blob, file_path)
+        return True
+    except OSError as e:
+        current_app.logger.error(
+            "Unable to add %s to the blob store: %s" % (file_path, e))
+        return False
+
+
+def references(sha256):
+    """ Returns the number of uploads referring to a blob """
+    try:
+        return os.stat(blob_path(sha256)).st_nlink - 1
+    except OSError:
+        return 0
+
+
+def collect_garbage():
+    """
+    Removes the blobs no upload refers to any more.
+    Returns a tuple of the number of blobs removed and the bytes freed.
+    """
+    removed = freed = 0
+    if not is_enabled():
+        return removed, freed
+    for dirpath, dirnames, filenames in os.walk(CFG_SIMPLESTORE_BLOB_FOLDER):
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            try:
+                st = os.stat(path)
+                if st.st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+                    freed += st.st_size
+            except OSError:
+                pass
+    return removed, freed
@@ -18,10 +18,14 @@
 ## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
 
 """SimpleStore Flask Blueprint"""
-from flask import request
+from flask import request, current_app
 from invenio.webinterface_handler_flask_utils import _, InvenioBlueprint
 import invenio.simplestore_upload_handler as uph
 import invenio.simplestore_deposit_handler as dep
+import invenio.simplestore_typeahead as typeahead_handler
+import invenio.simplestore_batch as batch
+import invenio.simplestore_spool as spool
+import invenio.simplestore_manifest as manifest
 
 blueprint = InvenioBlueprint('simplestore', __name__,
                              url_prefix='/deposit',
@@ -44,12 +48,48 @@ def addmeta(sub_id):
     return dep.addmeta(request, sub_id)
 
 
+@blueprint.route('/validate/<domain>', methods=['POST'])
+@blueprint.invenio_authenticated
+def validate(domain):
+    return dep.validate(request, domain)
+
+
+@blueprint.route('/batch', methods=['POST'])
+@blueprint.invenio_authenticated
+def batch_deposit():
+    return batch.batch_deposit(request)
+
+
 @blueprint.route('/upload/<sub_id>', methods=['POST'])
 @blueprint.invenio_authenticated
 def upload(sub_id):
     return uph.upload(request, sub_id)
 
 
+@blueprint.route('/upload_raw/<sub_id>', methods=['POST'])
+@blueprint.invenio_authenticated
+def upload_raw(sub_id):
+    return uph.upload_raw(request, sub_id)
+
+
+@blueprint.route('/upload_precheck/<sub_id>', methods=['POST'])
+@blueprint.invenio_authenticated
+def upload_precheck(sub_id):
+    return uph.upload_precheck(request, sub_id)
+
+
+@blueprint.route('/upload_status/<sub_id>', methods=['GET'])
+@blueprint.invenio_authenticated
+def upload_status(sub_id):
+    return uph.upload_status(request, sub_id)
+
+
+@blueprint.route('/chunk_size/<sub_id>', methods=['GET'])
+@blueprint.invenio_authenticated
+def chunk_size(sub_id):
+    return uph.chunk_size(request, sub_id)
+
+
 @blueprint.route('/delete/<sub_id>', methods=['POST'])
 @blueprint.invenio_authenticated
 def delete(sub_id):
@@ -59,7 +99,7 @@ def delete(sub_id):
 @blueprint.route('/get_file/<sub_id>', methods=['GET'])
 @blueprint.invenio_authenticated
 def get_file(sub_id):
-    # XXX uses insecure function
+    # XXX any authenticated user knowing the sub_id can get its files
     # - option A: should check for UUID of a submission and disallow foreign GETs
     # - option B: should remove a link from the upload form for good and remove the handler
     return uph.get_file(request, sub_id)
@@ -71,13 +111,39 @@ def getform(sub_id, domain):
     return dep.getform(request, sub_id, domain)
 
 
+@blueprint.route('/typeahead/<source>', methods=['GET'])
+@blueprint.invenio_authenticated
+def typeahead(source):
+    return typeahead_handler.typeahead(request, source)
+
+
 @blueprint.route('/check_status/<sub_id>/', methods=['GET', 'POST'])
 @blueprint.invenio_authenticated
 def check_status(sub_id):
-    return uph.check_status(sub_id)
+    _flush_spooled(sub_id)
+    return uph.check_status(request, sub_id)
 
 
 @blueprint.route('/check_status/', methods=['GET', 'POST'])
 @blueprint.invenio_authenticated
 def check_status_noarg():
-    return uph.check_status_noarg()
+    _flush_spooled(request.values.get('sub_id'))
+    return uph.check_status_noarg(request)
+
+
+def _flush_spooled(sub_id):
+    """
+    Flushes the spool if it is due and holds the record of submission
+    sub_id. The timer of the process which spooled the record dies with
+    it, the depositor waiting for the record need not wait for the
+    janitor. Errors are logged, the status is reported anyway.
+    """
+    if not sub_id:
+        return
+    try:
+        job = manifest.read_manifest(uph.get_upload_dir(sub_id)).get('job')
+        if job and job.get('stage') == 'spooled':
+            spool.flush()
+    except Exception:
+        current_app.logger.exception("Flushing the spool for %s failed" %
+                                     sub_id)
@@ -18,18 +18,15 @@
 ## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
 
 import uuid
-import time
 import os
-from tempfile import mkstemp
+from datetime import date
 
 from flask.ext.wtf import Form
-from flask import render_template, redirect, url_for, current_app, jsonify
+from flask import render_template, redirect, url_for, current_app, jsonify, g
 from wtforms.ext.sqlalchemy.orm import model_form
 from wtforms.ext.csrf.session import SessionSecureForm
 
 from invenio.config import CFG_SITE_SECRET_KEY
-from invenio.bibtask import task_low_level_submission
-from invenio.config import CFG_TMPSHAREDDIR
 from invenio.wtforms_utils import InvenioBaseForm
 from invenio.webuser_flask import current_user
 
@@ -37,7 +34,7 @@ from invenio.simplestore_model.HTML5ModelConverter import HTML5ModelConverter
 import invenio.simplestore_upload_handler as uph
 from invenio.simplestore_model.model import SubmissionMetadata
 from invenio.simplestore_model import metadata_classes
-import invenio.simplestore_marc_handler as mh
+import invenio.simplestore_finalize as finalize
 
 
 # InvenioBaseForm is taking care of the csrf
@@ -45,77 +42,127 @@ class FormWithKey(InvenioBaseForm):
     pass
 
 
+# form class of every metadata class, built on first use
+_form_classes = {}
+
+# rendered empty form of every metadata class, by language and day, with
+# CSRF_SENTINEL in place of the CSRF token, and the template it came from.
+# Domains are configured by modules, so the fragments of this process
+# cannot get out of date unless the template changes
+_form_fragments = {}
+CSRF_SENTINEL = '@@SIMPLESTORE_CSRF_TOKEN@@'
+
+
+def get_form_class(domain):
+    """
+    Returns the metadata class of domain, the generic one for an unknown
+    domain, and the form class for it. Building a form class introspects
+    the mapper of the metadata class, so it is done only once per class.
+    """
+    meta_class = metadata_classes.get(domain, SubmissionMetadata)
+    form_class = _form_classes.get(meta_class)
+    if form_class is None:
+        # the field arguments are only complete once an instance exists
+        meta = meta_class()
+        form_class = model_form(meta_class, base_class=FormWithKey,
+                                exclude=['submission', 'submission_type'],
+                                field_args=meta.field_args,
+                                converter=HTML5ModelConverter())
+        # building it twice in a race is harmless
+        _form_classes[meta_class] = form_class
+    return meta_class, form_class
+
+
 def deposit(request, sub_id=None, form=None, metadata=None):
     """ Renders the deposit start page """
     return render_template('simplestore-deposit.html',
                            url_prefix=url_for('.deposit'),
                            domains=metadata_classes.values(),
-                           sub_id=uuid.uuid1().hex)
+                           sub_id=uuid.uuid1().hex,
+                           extract_archives=uph.CFG_SIMPLESTORE_UPLOAD_EXTRACT,
+                           chunk_size=uph.CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE,
+                           max_chunk_size=uph.CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE)
 
 
 def getform(request, sub_id, domain):
     """
     Returns a metadata form tailored to the given domain.
+    The empty form is rendered once per language and day, and served with
+    the CSRF token of the request put in.
     """
 
-    domain = domain.lower()
-    if domain in metadata_classes:
-        meta = metadata_classes[domain]()
-    else:
-        meta = SubmissionMetadata()
-
-    MetaForm = model_form(meta.__class__, base_class=FormWithKey,
-                          exclude=['submission', 'submission_type'],
-                          field_args=meta.field_args,
-                          converter=HTML5ModelConverter())
+    meta_class, MetaForm = get_form_class(domain.lower())
+    meta = meta_class()
     meta_form = MetaForm(request.form, meta)
-
-    return render_template(
-        'simplestore-addmeta-table.html',
+    token = meta_form.csrf_token._value()
+    cacheable = token and not request.form
+
+    # the empty form is the same for everyone but for the CSRF token
+    today = date.today()
+    key = (meta_class, g.ln, today)
+    cached = _form_fragments.get(key)
+    if cacheable and cached is not None and cached[1].is_up_to_date:
+        return cached[0].replace(CSRF_SENTINEL, token)
+
+    template = current_app.jinja_env.get_template(
+        'simplestore-addmeta-table.html')
+    html = render_template(
+        template,
         sub_id=sub_id,
         metadata=meta,
         form=meta_form,
         getattr=getattr)
+    if cacheable:
+        # fragments of the previous days are of no use any more; other
+        # threads may change the cache while we go through a copy of it
+        for k in [k for k in list(_form_fragments.keys()) if k[2] != today]:
+            _form_fragments.pop(k, None)
+        _form_fragments[key] = (html.replace(token, CSRF_SENTINEL), template)
+    return html
 
 
 def addmeta(request, sub_id):
     """
     Checks the submitted metadata form for validity.
-    Returns a new page with success message if valid, otherwise it returns a
-    form with the errors marked.
+    Returns a new page with success message if valid, otherwise it returns
+    the errors by field name and a form with the errors marked, or just the
+    errors if the errors_only argument is set.
     """
     current_app.logger.error("Adding metadata")
     if sub_id is None:
         #just return to deposit
         return redirect(url_for('.deposit'))
-    updir = os.path.join(uph.CFG_SIMPLESTORE_UPLOAD_FOLDER, sub_id)
-    if (not os.path.isdir(updir)) or (not os.listdir(updir)):
+    updir = uph.get_upload_dir(sub_id)
+    if (not os.path.isdir(updir)) or (not uph.list_uploaded_files(updir)):
         return render_template('500.html', message="Uploads not found"), 500
 
-    domain = request.form['domain'].lower()
-    if domain in metadata_classes:
-        meta = metadata_classes[domain]()
-    else:
-        meta = SubmissionMetadata()
-    
-    MetaForm = model_form(meta.__class__, base_class=FormWithKey,
-                          exclude=['submission', 'submission_type'],
-                          field_args=meta.field_args,
-                          converter=HTML5ModelConverter())
+    meta_class, MetaForm = get_form_class(request.form['domain'].lower())
+    meta = meta_class()
     meta_form = MetaForm(request.form, meta)
     
     current_app.logger.error("about to validate")
     if meta_form.validate_on_submit():
-        recid, marc = mh.create_marc(
-            request.form, sub_id, current_user['email'])
-        tmp_file = write_marc_to_temp_file(marc)
-        task_low_level_submission('bibupload', 'webdeposit', '-r', tmp_file)
+        # the record is created in the background; a second submission
+        # of the form just gets the status of the first one
+        finalize.submit(sub_id, request.form, current_user['email'])
+        status_url = url_for('.check_status', sub_id=sub_id)
         return jsonify(valid=True,
-                       html=render_template('simplestore-finalise.html',
-                                            recid=recid, marc=marc))
+                       job=sub_id,
+                       status_url=status_url,
+                       html=render_template('simplestore-finalize.html',
+                                            sub_id=sub_id,
+                                            status_url=status_url))
 
     current_app.logger.error("returning form addmeta")
+    # clients which mark the errors themselves need no new form, but a
+    # new CSRF token if theirs has expired
+    if request.args.get('errors_only'):
+        if 'csrf_token' in meta_form.errors:
+            return jsonify(valid=False, errors=meta_form.errors,
+                           csrf_token=meta_form.csrf_token._value())
+        return jsonify(valid=False, errors=meta_form.errors)
     return jsonify(valid=False,
+                   errors=meta_form.errors,
                    html=render_template('simplestore-addmeta-table.html',
                                         sub_id=sub_id,
                                         metadata=meta,
@@ -123,17 +170,18 @@ def addmeta(request, sub_id):
                                         getattr=getattr))
 
 
-def write_marc_to_temp_file(marc):
+def validate(request, domain):
     """
-    Writes out the MARCXML to a file.
+    Validates the fields posted with the metadata form of domain, and
+    returns their errors by field name. Only the fields posted are
+    reported on, so that a form can be checked field by field as it is
+    filled in; the CSRF token is checked on submission only.
     """
-    tmp_file_fd, tmp_file_name = mkstemp(
-        suffix='.marcxml',
-        prefix="webdeposit_%s" % time.strftime("%Y-%m-%d_%H:%M:%S"),
-        dir=CFG_TMPSHAREDDIR)
-
-    os.write(tmp_file_fd, marc.encode('utf8'))
-    os.close(tmp_file_fd)
-    os.chmod(tmp_file_name, 0644)
+    meta_class, MetaForm = get_form_class(domain.lower())
+    meta_form = MetaForm(request.form, meta_class(), csrf_enabled=False)
+    meta_form.validate()
+    errors = dict((name, messages)
+                  for name, messages in meta_form.errors.items()
+                  if name in request.form)
+    return jsonify(valid=not errors, errors=errors)
 
-    return tmp_file_name
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Deposit Finalization
+
+Turns a submission whose metadata has been accepted into a record: gets a
+record id, computes the checksum, registers a PID, generates the MARCXML
+and adds it to the spool of records for bibupload. The PID service in
+particular can be slow, so this is done by a pool of worker threads
+rather than in the request.
+
+The job of a submission is identified by its sub_id. Every stage it
+reaches is recorded in the 'job' entry of the submission manifest, where
+check_status finds it; the stages are 'queued', 'recid', 'metadata',
+'checksum', 'pid', 'marc', 'spooled' and finally 'done' or 'failed'.
+
+With CFG_SIMPLESTORE_FINALIZE_WORKERS set to 0, jobs are run in the
+request instead, as before.
+"""
+import Queue
+import logging
+import threading
+
+from flask import current_app
+
+from invenio.config import CFG_SITE_SECURE_URL
+from invenio.simplestore_upload_handler import get_upload_dir
+import invenio.simplestore_marc_handler as mh
+import invenio.simplestore_manifest as manifest
+import invenio.simplestore_spool as spool
+
+# If CFG_SIMPLESTORE_FINALIZE_WORKERS is not found in invenio-local.conf,
+# default is 2 finalization threads per process
+try:
+    from invenio.config import CFG_SIMPLESTORE_FINALIZE_WORKERS
+except ImportError:
+    CFG_SIMPLESTORE_FINALIZE_WORKERS = 2
+
+# If CFG_SIMPLESTORE_FINALIZE_TIMEOUT is not found in invenio-local.conf,
+# default is to give up on a job that has not made progress for an hour,
+# e.g. because its process was restarted, and let it be submitted again
+try:
+    from invenio.config import CFG_SIMPLESTORE_FINALIZE_TIMEOUT
+except ImportError:
+    CFG_SIMPLESTORE_FINALIZE_TIMEOUT = 3600
+
+_queue = Queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+# child of the logger of the application, so that its handlers apply
+_log = logging.getLogger(__name__)
+
+
+def submit(sub_id, form, email):
+    """
+    Queues the finalization of submission sub_id, with the metadata in
+    form and the email of the depositor. Returns False if the submission
+    is already being finalized or has been.
+    """
+    upload_dir = get_upload_dir(sub_id)
+    if not manifest.start_job(upload_dir, sub_id,
+                              CFG_SIMPLESTORE_FINALIZE_TIMEOUT):
+        return False
+    # the request and its form are gone by the time the job runs
+    enqueue(run, current_app._get_current_object(), sub_id, form.copy(),
+            email)
+    return True
+
+
+def enqueue(func, *args):
+    """
+    Has func(*args) called by a worker thread, or calls it at once if
+    there are no workers. The job must not rely on the current request.
+    """
+    if CFG_SIMPLESTORE_FINALIZE_WORKERS > 0:
+        _start_workers()
+        _queue.put((func, args))
+    else:
+        func(*args)
+
+
+def _start_workers():
+    """
+    Starts the worker threads of this process, if not done yet. They are
+    started on first use, so that they are not lost when a server forks
+    its workers after loading the application.
+    """
+    if len(_workers) >= CFG_SIMPLESTORE_FINALIZE_WORKERS and \
+            all(worker.is_alive() for worker in _workers):
+        return
+    with _workers_lock:
+        # should a worker have died anyway, it is replaced
+        _workers[:] = [worker for worker in _workers if worker.is_alive()]
+        while len(_workers) < CFG_SIMPLESTORE_FINALIZE_WORKERS:
+            worker = threading.Thread(
+                target=_work, name='simplestore-finalize-%d' % len(_workers))
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+
+
+def _work():
+    """ Runs queued jobs, forever """
+    while True:
+        func, args = _queue.get()
+        try:
+            func(*args)
+        except Exception:
+            # the worker must outlive the job
+            _log.exception("Job %s failed" % getattr(func, '__name__', func))
+        finally:
+            _queue.task_done()
+
+
+def run(app, sub_id, form, email):
+    """
+    Finalizes submission sub_id, recording the progress in its manifest.
+    Errors are logged and recorded in the manifest, not raised.
+    """
+    upload_dir = get_upload_dir(sub_id)
+
+    def progress(stage, **fields):
+        manifest.update_job(upload_dir, stage, **fields)
+
+    with app.app_context():
+        try:
+            recid, marc = mh.create_marc(form, sub_id, email, progress)
+            # the spool submits the record with others, and marks the
+            # job as done once it has
+            progress('spooled', recid=recid,
+                     url='%s/record/%s' % (CFG_SITE_SECURE_URL, recid))
+            spool.add(sub_id, marc)
+        except Exception as e:
+            app.logger.exception("Finalization of %s failed" % sub_id)
+            try:
+                manifest.update_job(upload_dir, 'failed', state='failed',
+                                    error=str(e) or e.__class__.__name__)
+            except Exception:
+                # e.g. the submission has been removed meanwhile
+                app.logger.exception("Cannot record the failure of %s" %
+                                     sub_id)
+
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Ingest Pipeline
+
+Computes the properties of an uploaded file while it is being written, so
+nothing has to read the file again afterwards. A pipeline is a list of
+stages; every block of data written to disk is fed to each stage in turn,
+and once the file is complete every stage adds what it found to a
+dictionary of results, which ends up in the manifest entry of the file.
+
+Stages have two methods: update(block), called with the data of the file
+in order, and report(results). The stages used are a hash for each of
+CFG_SIMPLESTORE_INGEST_HASHES, a byte counter, MIME type detection on the
+first bytes (with python-magic, if installed) and, optionally, the scanner
+class named by CFG_SIMPLESTORE_INGEST_SCANNER, e.g. to hand the data to a
+virus scanner.
+"""
+import hashlib
+
+# If CFG_SIMPLESTORE_INGEST_HASHES is not found in invenio-local.conf,
+# default is to compute SHA-256 only. SHA-256 is always computed, the
+# submission checksum and the blob store rely on it
+try:
+    from invenio.config import CFG_SIMPLESTORE_INGEST_HASHES
+except ImportError:
+    CFG_SIMPLESTORE_INGEST_HASHES = ['sha256']
+
+# If CFG_SIMPLESTORE_INGEST_SCANNER is not found in invenio-local.conf,
+# default is not to scan uploads. Otherwise it is the dotted name of a
+# stage class, e.g. 'invenio.mysite_clamav.ClamdStage'
+try:
+    from invenio.config import CFG_SIMPLESTORE_INGEST_SCANNER
+except ImportError:
+    CFG_SIMPLESTORE_INGEST_SCANNER = None
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+# number of bytes MIME type detection looks at
+SNIFF_SIZE = 8192
+# size of the blocks read when a file is ingested from disk
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class HashStage(object):
+    """ Computes a hash of the file with one of the hashlib algorithms """
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+
+    def update(self, block):
+        self.hash.update(block)
+
+    def report(self, results):
+        results['checksums'][self.algorithm] = self.hash.hexdigest()
+
+
+class SizeStage(object):
+    """ Counts the bytes of the file """
+
+    def __init__(self):
+        self.size = 0
+
+    def update(self, block):
+        self.size += len(block)
+
+    def report(self, results):
+        results['size'] = self.size
+
+
+class MimeStage(object):
+    """
+    Detects the MIME type of the file from its first SNIFF_SIZE bytes.
+    Without python-magic nothing is reported, and the type is guessed
+    from the file name when the file is recorded.
+    """
+
+    def __init__(self):
+        self.head = ''
+
+    def update(self, block):
+        if len(self.head) < SNIFF_SIZE:
+            self.head += block[:SNIFF_SIZE - len(self.head)]
+
+    def report(self, results):
+        if magic is None or not self.head:
+            return
+        try:
+            results['mime'] = magic.from_buffer(self.head, mime=True)
+        except Exception:
+            # python-magic and filemagic both install a 'magic' module
+            # with different interfaces; we just go without
+            pass
+
+
+class Pipeline(object):
+    """ Feeds the data of a file to a list of stages """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def update(self, block):
+        for stage in self.stages:
+            stage.update(block)
+
+    def results(self):
+        """
+        Returns the dictionary of results of all stages. The SHA-256 is
+        also given as 'sha256', as it is stored in the manifest.
+        """
+        results = dict(checksums={})
+        for stage in self.stages:
+            stage.report(results)
+        results['sha256'] = results['checksums'].get('sha256')
+        return results
+
+
+def _load_scanner():
+    """ Returns the scanner stage class, or None if none is configured """
+    if not CFG_SIMPLESTORE_INGEST_SCANNER:
+        return None
+    module_name, class_name = CFG_SIMPLESTORE_INGEST_SCANNER.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+_scanner_class = _load_scanner()
+
+
+def new_pipeline():
+    """ Returns a pipeline with the configured stages """
+    algorithms = ['sha256'] + [a for a in CFG_SIMPLESTORE_INGEST_HASHES
+                               if a != 'sha256']
+    stages = [HashStage(a) for a in algorithms]
+    stages.append(SizeStage())
+    stages.append(MimeStage())
+    if _scanner_class is not None:
+        stages.append(_scanner_class())
+    return Pipeline(stages)
+
+
+def ingest_file(path, pipeline=None, offset=0):
+    """
+    Feeds the file at path to pipeline and returns the results. If pipeline
+    is given it must already have been fed the first offset bytes of the
+    file, and only the rest of the file is read; otherwise a new pipeline
+    is fed the whole file.
+    """
+    if pipeline is None:
+        pipeline = new_pipeline()
+        offset = 0
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        while True:
+            block = fp.read(READ_BUFFER_SIZE)
+            if not block:
+                break
+            pipeline.update(block)
+    return pipeline.results()
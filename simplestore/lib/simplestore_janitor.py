@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Janitor
+
+Bibsched task reclaiming the space of abandoned submissions. Every visit of
+the deposit page starts a new submission, and whatever was uploaded for a
+submission that never got its metadata stays in the upload folder. The
+janitor removes such submissions once they have not been touched for a
+while, and submitted ones once bibupload has had plenty of time to take
+their files. Directories are removed in small batches with a pause in
+between, so the upload volume stays responsive. The janitor also submits
+the records left in the bibupload spool by a process that died.
+
+The task has to be listed in CFG_BIBTASK_VALID_TASKS to be run by bibsched.
+"""
+
+__revision__ = "$Id$"
+
+import os
+import time
+import shutil
+
+from invenio.bibtask import task_init, write_message, task_set_option, \
+    task_get_option, task_update_progress, task_sleep_now_if_required
+from invenio.simplestore_upload_handler import iter_upload_dirs, \
+    migrate_upload_folder
+import invenio.simplestore_manifest as manifest
+import invenio.simplestore_blobstore as blobstore
+import invenio.simplestore_quota as quota
+import invenio.simplestore_spool as spool
+
+# default age, in hours, after which an unsubmitted submission is abandoned
+DEFAULT_MAX_AGE = 48
+# default age, in hours, after which the uploads of a submission whose
+# record has been handed to bibupload are no longer needed
+DEFAULT_SUBMITTED_MAX_AGE = 7 * 24
+DEFAULT_BATCH_SIZE = 100
+# default pause, in seconds, between two batches
+DEFAULT_PAUSE = 1.0
+
+
+def submission_age(upload_dir, now):
+    """
+    Returns a tuple of the number of seconds since the submission in
+    upload_dir was last changed and its state. Submissions without a
+    manifest are dated by the modification time of their directory.
+    """
+    if os.path.isfile(os.path.join(upload_dir, manifest.MANIFEST_FILENAME)):
+        stored = manifest.read_manifest(upload_dir)
+        return now - stored['updated'], stored.get('state')
+    return now - os.path.getmtime(upload_dir), None
+
+
+def is_stale(upload_dir, now, max_age, submitted_max_age):
+    """ Returns True if the submission in upload_dir can be removed """
+    age, state = submission_age(upload_dir, now)
+    if state is None:
+        return age > max_age
+    return age > submitted_max_age
+
+
+def freed_size(upload_dir):
+    """
+    Returns the number of bytes removing upload_dir frees. Files that are
+    still linked from the blob store only free space once the blob is
+    collected, and are not counted.
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(upload_dir):
+        for f in filenames:
+            st = os.lstat(os.path.join(dirpath, f))
+            if st.st_nlink == 1:
+                size += st.st_size
+    return size
+
+
+def reserved_folders():
+    """
+    Returns the real paths of the folders of SimpleStore which may be kept
+    in the upload folder, but are not submissions: the blob store, the
+    quota slots and the bibupload spool.
+    """
+    folders = [quota.CFG_SIMPLESTORE_QUOTA_FOLDER,
+               spool.CFG_SIMPLESTORE_SPOOL_FOLDER]
+    if blobstore.is_enabled():
+        folders.append(blobstore.CFG_SIMPLESTORE_BLOB_FOLDER)
+    return [os.path.realpath(folder) for folder in folders]
+
+
+def find_stale_submissions(max_age, submitted_max_age):
+    """ Yields the directories of the submissions that can be removed """
+    now = time.time()
+    reserved = reserved_folders()
+    for sub_id, upload_dir in iter_upload_dirs():
+        path = os.path.realpath(upload_dir)
+        if any(folder == path or folder.startswith(path + os.sep)
+               for folder in reserved):
+            write_message("Skipping %s: not a submission" % upload_dir)
+            continue
+        try:
+            if is_stale(upload_dir, now, max_age, submitted_max_age):
+                yield upload_dir
+        except (OSError, IOError, ValueError) as e:
+            write_message("Skipping %s: %s" % (upload_dir, e))
+
+
+def clean_upload_folder(max_age, submitted_max_age, batch_size, pause,
+                        dry_run=False):
+    """
+    Removes the stale submissions in batches of batch_size, pausing for
+    pause seconds after each batch. Ages are given in seconds.
+    Returns a tuple of the number of submissions removed and bytes freed.
+    """
+    removed = freed = 0
+    batch = 0
+    for upload_dir in find_stale_submissions(max_age, submitted_max_age):
+        try:
+            size = freed_size(upload_dir)
+            if not dry_run:
+                shutil.rmtree(upload_dir)
+        except OSError as e:
+            write_message("Unable to remove %s: %s" % (upload_dir, e))
+            continue
+        write_message("Removed %s (%d bytes)" % (upload_dir, size), verbose=3)
+        removed += 1
+        freed += size
+        batch += 1
+        if batch == batch_size:
+            task_update_progress("Removed %d submissions, freed %d bytes"
+                                 % (removed, freed))
+            task_sleep_now_if_required(can_stop_too=True)
+            time.sleep(pause)
+            batch = 0
+    return removed, freed
+
+
+def task_run_core():
+    """ Runs the janitor """
+    # records whose process died before it could submit them
+    task_id = spool.flush()
+    if task_id is not None:
+        write_message("Submitted spooled records as bibupload task #%s"
+                      % task_id)
+    if task_get_option('migrate', False):
+        moved = migrate_upload_folder()
+        write_message("Moved %d submissions to the configured layout" % moved)
+    dry_run = task_get_option('dry_run', False)
+    removed, freed = clean_upload_folder(
+        task_get_option('max_age', DEFAULT_MAX_AGE) * 3600,
+        task_get_option('submitted_max_age', DEFAULT_SUBMITTED_MAX_AGE) * 3600,
+        task_get_option('batch_size', DEFAULT_BATCH_SIZE),
+        task_get_option('pause', DEFAULT_PAUSE),
+        dry_run)
+    if dry_run:
+        write_message("Would remove %d submissions, freeing %d bytes"
+                      % (removed, freed))
+        return True
+
+    blobs, blob_bytes = blobstore.collect_garbage()
+    write_message("Removed %d submissions and %d unused blobs, "
+                  "freed %d bytes" % (removed, blobs, freed + blob_bytes))
+    task_update_progress("Freed %d bytes" % (freed + blob_bytes))
+    return True
+
+
+def task_submit_elaborate_specific_parameter(key, value, opts, args):
+    """ Elaborates the janitor specific parameters """
+    try:
+        if key in ('-a', '--max-age'):
+            task_set_option('max_age', float(value))
+        elif key in ('-A', '--submitted-max-age'):
+            task_set_option('submitted_max_age', float(value))
+        elif key in ('-b', '--batch-size'):
+            task_set_option('batch_size', max(1, int(value)))
+        elif key in ('-p', '--pause'):
+            task_set_option('pause', float(value))
+        elif key in ('-n', '--dry-run'):
+            task_set_option('dry_run', True)
+        elif key in ('-m', '--migrate'):
+            task_set_option('migrate', True)
+        else:
+            return False
+    except ValueError:
+        raise StandardError("Invalid value for %s: %s" % (key, value))
+    return True
+
+
+def main():
+    """ Constructs the bibtask """
+    task_init(authorization_action='runbibtaskex',
+              authorization_msg="SimpleStore Janitor Task Submission",
+              description="""Remove abandoned submissions from the upload folder.
+Examples:
+    $ simplestore_janitor -s 1d
+    $ simplestore_janitor --max-age=24 --dry-run
+    $ simplestore_janitor --migrate
+""",
+              help_specific_usage="""  -a, --max-age=HOURS\tremove submissions without metadata not changed
+\t\t\tfor HOURS (default %d)
+  -A, --submitted-max-age=HOURS\tremove uploads of submitted records after
+\t\t\tHOURS (default %d)
+  -b, --batch-size=N\tremove N submissions at a time (default %d)
+  -p, --pause=SECONDS\tpause between batches (default %s)
+  -n, --dry-run\t\tonly report what would be removed
+  -m, --migrate\t\tfirst move the submissions to the layout set by
+\t\t\tCFG_SIMPLESTORE_UPLOAD_FOLDER_FANOUT
+""" % (DEFAULT_MAX_AGE, DEFAULT_SUBMITTED_MAX_AGE, DEFAULT_BATCH_SIZE,
+       DEFAULT_PAUSE),
+              version=__revision__,
+              specific_params=("a:A:b:p:nm",
+                               ["max-age=",
+                                "submitted-max-age=",
+                                "batch-size=",
+                                "pause=",
+                                "dry-run",
+                                "migrate"]),
+              task_submit_elaborate_specific_parameter_fnc=
+                  task_submit_elaborate_specific_parameter,
+              task_run_fnc=task_run_core)
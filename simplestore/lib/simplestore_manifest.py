@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Submission Manifest
+
+Keeps track of the chunks received for every file of a submission, so that
+an interrupted upload can be resumed instead of started over, and of the
+name, location, size, checksum and MIME type of every complete file.
+
+The manifest is a small JSON document stored in the submission directory.
+Chunks are recorded as ranges of chunk indexes; the offset and size of a
+chunk follow from its index, the chunk size and the size of the file.
+All updates are done under an exclusive lock and written atomically.
+"""
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import logging
+import threading
+import mimetypes
+from contextlib import contextmanager
+
+from invenio.jsonutils import json
+
+MANIFEST_FILENAME = '.manifest.json'
+LOCK_FILENAME = '.manifest.lock'
+
+# weight of the latest measurement in the throughput average
+THROUGHPUT_WEIGHT = 0.3
+
+# lockf only excludes other processes, so threads of this process
+# also take one of these locks, picked by submission directory
+_thread_locks = [threading.Lock() for i in range(64)]
+
+# child of the logger of the application, so that its handlers apply
+_log = logging.getLogger(__name__)
+
+
+def new_manifest():
+    """ Returns an empty manifest """
+    now = time.time()
+    return dict(created=now, updated=now, files={})
+
+
+def read_manifest(upload_dir):
+    """
+    Returns the manifest of the submission in upload_dir, or an empty one
+    if nothing has been recorded yet. A manifest that cannot be decoded is
+    logged and taken for an empty one, so that it is written anew.
+    """
+    path = os.path.join(upload_dir, MANIFEST_FILENAME)
+    try:
+        with open(path, 'rb') as fp:
+            return json.load(fp)
+    except IOError:
+        return new_manifest()
+    except ValueError:
+        _log.exception("Ignoring the undecodable manifest %s" % path)
+        return new_manifest()
+
+
+def write_manifest(upload_dir, manifest):
+    """
+    Atomically replaces the manifest of the submission in upload_dir.
+    Should only be called while holding the manifest lock.
+    """
+    manifest['updated'] = time.time()
+    path = os.path.join(upload_dir, MANIFEST_FILENAME)
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        json.dump(manifest, fp, separators=(',', ':'))
+        # the new manifest has to be on disk before it replaces the old one
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp_path, path)
+
+
+@contextmanager
+def locked_manifest(upload_dir):
+    """
+    Context manager giving exclusive access to the manifest of the
+    submission in upload_dir. Changes made to the yielded manifest are
+    written back when the block exits without an exception.
+    """
+    thread_lock = _thread_locks[hash(upload_dir) % len(_thread_locks)]
+    with thread_lock:
+        lock = open(os.path.join(upload_dir, LOCK_FILENAME), 'a')
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            manifest = read_manifest(upload_dir)
+            yield manifest
+            write_manifest(upload_dir, manifest)
+        finally:
+            # closing the file releases the lock
+            lock.close()
+
+
+def expected_chunk_size(entry, chunk):
+    """
+    Returns the number of bytes chunk should have, or None if this is
+    not known (i.e. the client did not tell us the chunk size).
+    """
+    if entry.get('chunk_size') is None or entry.get('size') is None:
+        return None
+    offset = chunk * entry['chunk_size']
+    return max(0, min(entry['chunk_size'], entry['size'] - offset))
+
+
+def add_chunk(entry, chunk):
+    """
+    Marks chunk as received in the ranges of a manifest file entry.
+    Returns False if the chunk had already been recorded.
+    """
+    ranges = entry['received']
+    for r in ranges:
+        if r[0] <= chunk < r[1]:
+            return False
+    ranges.append([chunk, chunk + 1])
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    entry['received'] = merged
+    return True
+
+
+def record_chunk(upload_dir, filename, name, chunk, chunks, size,
+                 chunk_size=None, total_size=None, elapsed=None):
+    """
+    Records that chunk (of chunks) with size bytes of file filename has
+    been written. A chunk that has not the expected size is not recorded,
+    so it will be reported as missing. If the request took elapsed seconds,
+    the throughput of the submission is updated as well.
+
+    Chunks may be recorded in any order and by concurrent requests.
+    Returns a tuple of the updated manifest entry of the file and a flag
+    which is True for exactly one caller: the one whose chunk completed the
+    file, and which therefore has to assemble it.
+
+    A chunk whose chunks, chunk_size or total_size differ from those of an
+    incomplete entry starts a new upload of the file, which replaces the
+    chunks recorded so far. So does any chunk of a complete file, unless
+    it has the same parameters: it has been sent again, e.g. because its
+    response was lost, and is only acknowledged. A complete file that is
+    replaced is removed.
+    """
+    with locked_manifest(upload_dir) as manifest:
+        entry = manifest['files'].get(filename)
+        if entry is not None and entry.get('complete') and \
+                same_upload(entry, chunks, chunk_size, total_size):
+            return entry, False
+        if entry is None or entry.get('complete') or \
+                (not entry.get('assembling') and
+                 not same_upload(entry, chunks, chunk_size, total_size)):
+            if entry is not None and entry.get('file'):
+                _remove_stored_file(entry['file'])
+            entry = dict(name=name, chunks=chunks, chunk_size=chunk_size,
+                         size=total_size, received=[], bytes_received=0,
+                         complete=False)
+            manifest['files'][filename] = entry
+        expected = expected_chunk_size(entry, chunk)
+        if expected is None or expected == size:
+            if add_chunk(entry, chunk):
+                entry['bytes_received'] += size
+        if elapsed and size:
+            update_throughput(manifest, size / elapsed)
+        last = (entry['received'] == [[0, entry['chunks']]] and
+                not entry.get('assembling'))
+        if last:
+            entry['assembling'] = True
+        return entry, last
+
+
+def same_upload(entry, chunks, chunk_size, total_size):
+    """
+    Returns True if the manifest entry of a file was recorded for chunks
+    with the given parameters.
+    """
+    return (entry['chunks'], entry.get('chunk_size'),
+            entry.get('size')) == (chunks, chunk_size, total_size)
+
+
+def complete_upload(upload_dir, filename, chunks, chunk_size, total_size):
+    """
+    Returns the manifest entry of file filename if it is complete and was
+    sent in chunks with the given parameters, otherwise None. A chunk of
+    such a file has been sent again and needs not be written.
+    """
+    entry = read_manifest(upload_dir)['files'].get(filename)
+    if entry is not None and entry.get('complete') and \
+            same_upload(entry, chunks, chunk_size, total_size):
+        return entry
+    return None
+
+
+def _remove_stored_file(file_path):
+    """ Removes a stored file which is replaced, unless it is gone """
+    try:
+        os.remove(file_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def assembly_failed(upload_dir, filename, chunks_lost=False):
+    """
+    Records that assembling file filename from its chunks has failed, so
+    that the next chunk recorded for it starts over. If chunks_lost is set,
+    the chunks received are gone as well and have to be sent again.
+    """
+    with locked_manifest(upload_dir) as manifest:
+        entry = manifest['files'].get(filename)
+        if entry is None or entry.get('complete'):
+            return
+        entry.pop('assembling', None)
+        if chunks_lost:
+            entry.update(received=[], bytes_received=0)
+
+
+def update_throughput(manifest, rate):
+    """
+    Adds a measured upload rate, in bytes per second, to the exponentially
+    weighted moving average kept in manifest['throughput'].
+    """
+    if manifest.get('throughput'):
+        rate = (THROUGHPUT_WEIGHT * rate +
+                (1 - THROUGHPUT_WEIGHT) * manifest['throughput'])
+    manifest['throughput'] = rate
+
+
+def record_file(upload_dir, filename, name, file_path, size, sha256=None,
+                properties=None):
+    """
+    Records a file that has been fully received and stored at file_path,
+    along with its SHA-256 hex digest and MIME type, and updates the
+    checksum of the submission. Returns the updated manifest entry.
+
+    @properties - further results of the ingest pipeline, e.g. checksums
+                  and the detected MIME type, stored in the entry as well
+    """
+    return record_files(upload_dir, [(filename, name, file_path, size,
+                                      sha256, properties)])[0]
+
+
+def record_files(upload_dir, files):
+    """
+    Records several complete files at once, e.g. the members of an archive,
+    with a single update of the manifest and of the submission checksum.
+    files is a list of tuples of the arguments of record_file(), after
+    upload_dir. Returns the list of the updated manifest entries.
+    """
+    entries = []
+    with locked_manifest(upload_dir) as manifest:
+        for filename, name, file_path, size, sha256, properties in files:
+            properties = dict(properties or {})
+            mime = properties.pop('mime', None) or \
+                mimetypes.guess_type(name)[0]
+            entry = manifest['files'].get(filename)
+            if entry is None:
+                entry = dict(name=name, chunks=1, chunk_size=None,
+                             received=[[0, 1]])
+                manifest['files'][filename] = entry
+            elif entry.get('file') and entry['file'] != file_path:
+                # a file sent again replaces the previous one
+                _remove_stored_file(entry['file'])
+            entry.update(properties)
+            entry.update(file=file_path, size=size, bytes_received=size,
+                         complete=True, sha256=sha256, mime=mime)
+            entry.pop('assembling', None)
+            entries.append(entry)
+        update_submission_checksum(manifest)
+    return entries
+
+
+def set_state(upload_dir, state):
+    """
+    Sets the state of the submission, e.g. 'submitted' once its record has
+    been handed to bibupload.
+    """
+    with locked_manifest(upload_dir) as manifest:
+        manifest['state'] = state
+
+
+def start_job(upload_dir, job_id, timeout):
+    """
+    Records that finalization job job_id of the submission has been queued,
+    unless another job is queued or running, or has succeeded. A job which
+    has not reported any progress for timeout seconds is assumed to have
+    died with its process, and can be replaced.
+    Returns True if the job has been recorded.
+    """
+    with locked_manifest(upload_dir) as manifest:
+        job = manifest.get('job')
+        if job is not None:
+            if job['stage'] == 'done':
+                return False
+            if job['stage'] != 'failed' and \
+                    time.time() - job['updated'] < timeout:
+                return False
+        now = time.time()
+        manifest['job'] = dict(id=job_id, stage='queued', queued=now,
+                               updated=now)
+        manifest['state'] = 'finalizing'
+        return True
+
+
+def update_job(upload_dir, stage, state=None, **fields):
+    """
+    Records that the finalization job of the submission has reached stage,
+    along with further fields such as the record id, and sets the state of
+    the submission if given.
+    """
+    with locked_manifest(upload_dir) as manifest:
+        job = manifest.setdefault('job', {})
+        job.update(fields)
+        job.update(stage=stage, updated=time.time())
+        if state is not None:
+            manifest['state'] = state
+
+
+def remove_file(upload_dir, filename):
+    """
+    Forgets file filename and returns its manifest entry, or None if the
+    file is not in the manifest.
+    """
+    if not os.path.isfile(os.path.join(upload_dir, MANIFEST_FILENAME)):
+        return None
+    with locked_manifest(upload_dir) as manifest:
+        entry = manifest['files'].pop(filename, None)
+        update_submission_checksum(manifest)
+        return entry
+
+
+def complete_files(manifest):
+    """
+    Returns a dictionary mapping the stored name of every complete file of
+    the manifest to its entry.
+    """
+    return dict((os.path.basename(entry['file']), entry)
+                for entry in manifest['files'].values()
+                if entry.get('complete'))
+
+
+def file_checksums(manifest):
+    """
+    Returns a dictionary mapping the stored name of every complete file
+    of the manifest to its SHA-256 hex digest, if known.
+    """
+    return dict((os.path.basename(entry['file']), entry.get('sha256'))
+                for entry in manifest['files'].values()
+                if entry.get('complete'))
+
+
+def submission_checksum(digests):
+    """
+    Returns the checksum of a submission: the SHA-256 of the SHA-256 hex
+    digests of its files, taken in the order of their stored names.
+    """
+    sha = hashlib.sha256()
+    for digest in digests:
+        sha.update(digest)
+    return sha.hexdigest()
+
+
+def update_submission_checksum(manifest):
+    """
+    Recomputes the submission checksum from the file checksums, or drops
+    it if the checksum of some file is unknown.
+    """
+    checksums = file_checksums(manifest)
+    if None in checksums.values():
+        manifest.pop('sha256', None)
+    else:
+        manifest['sha256'] = submission_checksum(
+            checksums[f] for f in sorted(checksums))
+
+
+def missing_chunks(entry):
+    """ Returns the sorted indexes of the chunks not yet received """
+    missing = []
+    next_chunk = 0
+    for start, end in entry['received']:
+        missing.extend(range(next_chunk, start))
+        next_chunk = end
+    missing.extend(range(next_chunk, entry['chunks']))
+    return missing
+
+
+def resume_offset(entry):
+    """
+    Returns the number of bytes received without gaps from the start of
+    the file, i.e. the offset a client can safely resume uploading from.
+    """
+    if entry.get('complete'):
+        return entry['size']
+    received = entry['received']
+    if not received or received[0][0] != 0 or not entry.get('chunk_size'):
+        return 0
+    return min(received[0][1] * entry['chunk_size'], entry['size'])
@@ -18,14 +18,14 @@
 
 import os
 from datetime import datetime
-import hashlib
-import pickle
 
-from invenio.dbquery import run_sql
+from invenio.simplestore_recid import new_recid
 from invenio.bibrecord import record_add_field, record_xml_output
-from invenio.config import (CFG_SIMPLESTORE_UPLOAD_FOLDER, CFG_SITE_NAME,
-                            CFG_SITE_SECURE_URL)
+from invenio.config import CFG_SITE_NAME, CFG_SITE_SECURE_URL
 from invenio.simplestore_epic import createHandle
+from invenio.simplestore_upload_handler import (list_uploaded_files,
+                                                file_sha256, get_upload_dir)
+import invenio.simplestore_manifest as manifest
 from flask import current_app
 from werkzeug.exceptions import HTTPException
 from invenio.simplestore_model import metadata_classes
@@ -98,37 +98,30 @@ def add_basic_fields(rec, form, email):
 
 def create_recid():
     """
-    Uses the DB to get a record id for the submission.
+    Gets a record id for the submission, from a block reserved in the DB.
     """
-    return run_sql("INSERT INTO bibrec(creation_date, modification_date) "
-                   "values(NOW(), NOW())")
+    return new_recid()
 
 
 def add_file_info(rec, form, email, sub_id, recid):
     """
     Adds the path to the file and access rights to ther record.
     """
-    upload_dir = os.path.join(CFG_SIMPLESTORE_UPLOAD_FOLDER, sub_id)
-    files = os.listdir(upload_dir)
+    upload_dir = get_upload_dir(sub_id)
+    files = list_uploaded_files(upload_dir)
     if 'open_access' in form:
         fft_status = 'firerole: allow any\n'
     else:
         fft_status = 'firerole: allow email "{0}"\ndeny all'.format(
             email)
+    # name, size etc. of every file are read from the manifest in one go
+    stored = manifest.complete_files(manifest.read_manifest(upload_dir))
     for f in files:
         path = os.path.join(upload_dir, f)
-        if f.startswith('metadata_'):
-            # we do not want to do load file metadata into Invenio as files, will extract into MARC fields
-            continue
-        # load corresponding metadata file
-        metadata = {}
-        metadata_filename = os.path.join(upload_dir, 'metadata_' + f)
-        if os.path.isfile(metadata_filename):
-            # expecting to load a dict with the following structure: dict(name=name, file=file_path, size=size)
-            metadata = pickle.load(open(metadata_filename, 'rb'))
-        else:
-            current_app.logger.error('Submitted file \'%s\' is missing metadata file, using default' % f)
-            metadata = dict(name=f, file=path, size=str(os.path.getsize(path)))
+        metadata = stored.get(f)
+        if metadata is None:
+            current_app.logger.error('Submitted file \'%s\' is missing from the manifest, using default' % f)
+            metadata = dict(name=f, file=path, size=os.path.getsize(path))
 
         record_add_field(rec, 'FFT',
                          subfields=[('a', path),
@@ -144,7 +137,7 @@ def add_file_info(rec, form, email, sub_id, recid):
         url = "{0}/record/{1}/files/{2}".format(CFG_SITE_SECURE_URL, recid, f)
         record_add_field(rec, '856', ind1='4',
                          subfields=[('u', url),
-                                    ('s', str(os.path.getsize(path)))])
+                                    ('s', str(metadata['size']))])
 
 
 def add_domain_fields(rec, form):
@@ -192,42 +185,54 @@ def add_epic_pid(rec, recid, checksum):
             raise e
 
 
-def create_marc(form, sub_id, email):
+def create_marc(form, sub_id, email, progress=None):
     """
     Generates MARC data used by Invenio from the filled out form, then
     submits it to the Invenio system.
+
+    @progress - function called with the name of every stage as it starts,
+                and with the record id once it is known
     """
+    if progress is None:
+        progress = lambda stage, **fields: None
     rec = {}
+    progress('recid')
     recid = create_recid()
+    progress('metadata', recid=recid)
     record_add_field(rec, '001', controlfield_value=str(recid))
     add_basic_fields(rec, form, email)
     add_domain_fields(rec, form)
     add_file_info(rec, form, email, sub_id, recid)
+    progress('checksum')
     checksum = create_checksum(rec, sub_id)
+    progress('pid')
     add_epic_pid(rec, recid, checksum)
+    progress('marc')
     marc = record_xml_output(rec)
 
     return recid, marc
 
 
-def create_checksum(rec, sub_id, buffersize=64 * 1024):
+def create_checksum(rec, sub_id):
     """
     Creates a checksum of all the files in the record, and adds it
     to the MARC.
+
+    The SHA-256 of every file is computed while it is uploaded and kept in
+    the submission manifest, so normally no file has to be read here. Only
+    files missing from the manifest are hashed again.
     Returns: checksum as a hex string
     """
-    sha = hashlib.sha256()
-    upload_dir = os.path.join(CFG_SIMPLESTORE_UPLOAD_FOLDER, sub_id)
-    files = sorted(os.listdir(upload_dir))
-    for f in files:
-        filepath = os.path.join(upload_dir, f)
-        with open(filepath, 'rb', buffering=0) as fp:
-            while True:
-                block = fp.read(buffersize)
-                if not block:
-                    break
-                sha.update(block)
-    cs = sha.hexdigest()
+    upload_dir = get_upload_dir(sub_id)
+    files = sorted(list_uploaded_files(upload_dir))
+    stored = manifest.read_manifest(upload_dir)
+    checksums = manifest.file_checksums(stored)
+    if stored.get('sha256') and sorted(checksums) == files:
+        cs = stored['sha256']
+    else:
+        cs = manifest.submission_checksum(
+            checksums.get(f) or file_sha256(os.path.join(upload_dir, f))
+            for f in files)
     record_add_field(rec, '024', ind1='7',
                      subfields=[('2', 'checksum'), ('a', cs)])
     return cs
@@ -26,7 +26,7 @@ from wtforms import Field
 from wtforms.widgets import Input, Select, HTMLString, html_params
 from wtforms.compat import text_type
 from cgi import escape
-from flask import current_app
+from flask import current_app, url_for
 
 
 class SwitchInput(Input):
@@ -137,6 +137,15 @@ class TypeAheadStringInput(Input):
         if 'value' not in kwargs:
             kwargs['value'] = field._value()
 
+        # values of a remote source are fetched as the user types, from
+        # the typeahead endpoint, instead of being put into the form
+        if field.data_remote:
+            kwargs['data-remote'] = url_for('simplestore.typeahead',
+                                            source=field.data_remote)
+            return HTMLString(
+                '<input autocomplete="off" data-provide="{0}" {1}>'.format(
+                field.data_provide, self.html_params(name=field.name, **kwargs)))
+
         return HTMLString(
             '<input autocomplete="off" data-provide="{0}" data-source=\'{1}\' {2}>'.format(
             field.data_provide, field.data_source, self.html_params(name=field.name, **kwargs)))
@@ -147,10 +156,12 @@ class TypeAheadStringField(StringField):
     widget = TypeAheadStringInput()
     data_provide = ""
     data_source = ""
+    data_remote = ""
 
-    def __init__(self, data_provide="", data_source="", **kwargs):
+    def __init__(self, data_provide="", data_source="", data_remote="", **kwargs):
         self.data_provide = data_provide
         self.data_source = data_source
+        self.data_remote = data_remote
         super(TypeAheadStringField, self).__init__(**kwargs)
 
 
@@ -1,6 +1,4 @@
 from invenio.sqlalchemyutils import db
-from invenio.simplestore_model.metadata.linguistics_lang_codes import lang_codes
-import json
 
 domain = "Linguistics"
 table_name = 'linguistics'
@@ -13,8 +11,8 @@ fields = [{'name':'language_code',
            'description': 'This element can be used to add an ISO language code from ' +\
                           'ISO-639-3 to uniquely identify the language a document ' +\
                           'is written in',
-           'data_provide': 'typeahead',
-           'data_source': json.dumps(lang_codes)},
+           'data_provide': 'typeahead-remote',
+           'data_remote': 'lang_codes'},
           {'name':'region',
            'display_text':'Country/Region',
            'col_type':db.String(256),
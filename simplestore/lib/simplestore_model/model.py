@@ -218,6 +218,8 @@ def _create_metadata_class(cfg):
             args['field_args'][f['name']]['data_provide'] = f.get('data_provide')
         if 'data_source' in f:
             args['field_args'][f['name']]['data_source'] = f.get('data_source')
+        if 'data_remote' in f:
+            args['field_args'][f['name']]['data_remote'] = f.get('data_remote')
         if 'default' in f:
             args['field_args'][f['name']]['default'] = f.get('default')
 
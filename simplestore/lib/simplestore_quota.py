@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Upload Quotas
+
+Limits the number of upload requests in progress, and the bytes they carry,
+per user and in total, so that one client cannot occupy every web server
+worker.
+
+An upload request holds a slot while it runs. Slots are files in
+CFG_SIMPLESTORE_QUOTA_FOLDER, held with a lockf lock, so they are shared by
+all worker processes and freed by the kernel if a worker dies. The holder of
+a slot writes the size of its request into the slot file, so the bytes in
+flight are the sum over the held slots. Slots are looked at and taken under
+a guard lock of the directory.
+"""
+import os
+import errno
+import fcntl
+import hashlib
+import threading
+
+from invenio.config import CFG_SIMPLESTORE_UPLOAD_FOLDER
+
+# If CFG_SIMPLESTORE_QUOTA_FOLDER is not found in invenio-local.conf,
+# default is a hidden directory of the upload folder
+try:
+    from invenio.config import CFG_SIMPLESTORE_QUOTA_FOLDER
+except ImportError:
+    CFG_SIMPLESTORE_QUOTA_FOLDER = os.path.join(CFG_SIMPLESTORE_UPLOAD_FOLDER,
+                                                '.quota')
+
+# If CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER is not found in
+# invenio-local.conf, default is 4 upload requests per user at a time.
+# 0 disables the limit, as for the other limits below
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER = 4
+
+# If CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT is not found in invenio-local.conf,
+# default is 32 upload requests at a time
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT = 32
+
+# If CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT_PER_USER is not found in
+# invenio-local.conf, default is 64 MB in flight per user
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT_PER_USER
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT_PER_USER = 64 * 1024 * 1024
+
+# If CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT is not found in invenio-local.conf,
+# default is 512 MB in flight in total
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT = 512 * 1024 * 1024
+
+# If CFG_SIMPLESTORE_UPLOAD_RETRY_AFTER is not found in invenio-local.conf,
+# default is to ask clients over the limits to retry in 2 seconds
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_RETRY_AFTER
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_RETRY_AFTER = 2
+
+GUARD_FILENAME = '.guard'
+
+# lockf locks belong to the process, so the slots held by threads of this
+# process are tracked here, with the size of their requests, and must not
+# be opened again: closing any descriptor of a file drops the lock
+_held = {}
+_held_lock = threading.Lock()
+
+
+class QuotaExceeded(Exception):
+    """ The upload would exceed a limit; it may be retried later """
+
+    def __init__(self, message, retry_after=None):
+        Exception.__init__(self, message)
+        if retry_after is None:
+            retry_after = CFG_SIMPLESTORE_UPLOAD_RETRY_AFTER
+        self.retry_after = retry_after
+
+
+def user_directory(user_id):
+    """ Returns the slot directory of a user """
+    return os.path.join(CFG_SIMPLESTORE_QUOTA_FOLDER, 'users',
+                        hashlib.sha1(str(user_id)).hexdigest()[:16])
+
+
+def global_directory():
+    """ Returns the slot directory shared by all users """
+    return os.path.join(CFG_SIMPLESTORE_QUOTA_FOLDER, 'global')
+
+
+def _slot_size(path):
+    """ Returns the size of the request holding the slot at path """
+    try:
+        with open(path, 'rb') as fp:
+            return int(fp.read() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def _take_slot(directory, slots, max_bytes, size):
+    """
+    Takes a free one of the slots in directory for a request of size bytes.
+    Returns a tuple of the path and open file of the slot, or None if all
+    slots are taken or the bytes in flight would exceed max_bytes. A request
+    is let through on its own even if it is larger than max_bytes.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with _held_lock:
+        guard = open(os.path.join(directory, GUARD_FILENAME), 'a')
+        try:
+            fcntl.lockf(guard, fcntl.LOCK_EX)
+            free = None
+            inflight = 0
+            for i in range(slots):
+                path = os.path.join(directory, 'slot%d' % i)
+                if path in _held:
+                    inflight += _held[path]
+                    continue
+                fp = open(path, 'a+')
+                try:
+                    fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    # held by another process
+                    fp.close()
+                    inflight += _slot_size(path)
+                    continue
+                if free is None:
+                    free = (path, fp)
+                else:
+                    fp.close()
+            if free is not None and max_bytes and inflight and \
+                    inflight + size > max_bytes:
+                free[1].close()
+                free = None
+            if free is not None:
+                path, fp = free
+                fp.truncate(0)
+                fp.write(str(size))
+                fp.flush()
+                _held[path] = size
+            return free
+        finally:
+            # closing the file releases the lock
+            guard.close()
+
+
+def _release_slot(slot):
+    """ Frees a slot taken with _take_slot """
+    path, fp = slot
+    with _held_lock:
+        del _held[path]
+        fp.close()
+
+
+def acquire(user_id, size):
+    """
+    Takes the slots for an upload request of size bytes by user user_id,
+    and returns them, to be given back with release(). Raises QuotaExceeded
+    if the user or the site has too many uploads in progress.
+    """
+    slots = []
+    limits = [(user_directory(user_id),
+               CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER,
+               CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT_PER_USER,
+               "You have too many uploads in progress"),
+              (global_directory(),
+               CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT,
+               CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT,
+               "The server is busy")]
+    for directory, concurrent, max_bytes, message in limits:
+        if not concurrent:
+            continue
+        slot = _take_slot(directory, concurrent, max_bytes, size)
+        if slot is None:
+            release(slots)
+            raise QuotaExceeded(message)
+        slots.append(slot)
+    return slots
+
+
+def release(slots):
+    """ Frees the slots returned by acquire() """
+    for slot in slots:
+        _release_slot(slot)
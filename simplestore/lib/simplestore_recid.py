@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Record Id Allocator
+
+Hands out new record ids from blocks reserved in the bibrec table, so that
+creating a record does not need a round trip to the database each time.
+
+A block of CFG_SIMPLESTORE_RECID_BLOCK_SIZE rows is inserted into bibrec
+with a single statement. The next id to hand out and the end of the
+current block are kept in CFG_SIMPLESTORE_RECID_FILE, which is read and
+updated under a lockf lock, so the block is shared by all processes and
+survives restarts. An id is never handed out twice: if the file is lost,
+the rest of the block is merely left unused.
+
+The rows of a block exist before their ids are handed out, as empty
+records, and the dates of a row are only set when its id is taken. So
+the block is kept small: a larger one saves few round trips, but leaves
+more empty rows in bibrec until they are used, or for good if the file is
+lost.
+
+Multi-row inserts only get consecutive ids if innodb_autoinc_lock_mode is
+not 2 ('interleaved'); otherwise ids are reserved one at a time.
+"""
+import os
+import fcntl
+import threading
+
+from invenio.config import CFG_TMPSHAREDDIR
+from invenio.dbquery import run_sql
+
+# If CFG_SIMPLESTORE_RECID_BLOCK_SIZE is not found in invenio-local.conf,
+# default is to reserve 10 record ids at a time. 1 reserves every id when
+# it is needed
+try:
+    from invenio.config import CFG_SIMPLESTORE_RECID_BLOCK_SIZE
+except ImportError:
+    CFG_SIMPLESTORE_RECID_BLOCK_SIZE = 10
+
+# If CFG_SIMPLESTORE_RECID_FILE is not found in invenio-local.conf,
+# default is a file of the shared temporary folder
+try:
+    from invenio.config import CFG_SIMPLESTORE_RECID_FILE
+except ImportError:
+    CFG_SIMPLESTORE_RECID_FILE = os.path.join(CFG_TMPSHAREDDIR,
+                                              'simplestore_recids')
+
+# lockf only excludes other processes
+_lock = threading.Lock()
+# whether multi-row inserts get consecutive ids, checked on first use
+_consecutive = None
+
+
+def reserve_block(size):
+    """
+    Inserts size rows into bibrec in one statement, and returns the id of
+    the first one.
+    """
+    values = ', '.join(['(NOW(), NOW())'] * size)
+    return run_sql("INSERT INTO bibrec (creation_date, modification_date) "
+                   "VALUES " + values)
+
+
+def _inserts_are_consecutive():
+    """ Returns True if the rows of a multi-row insert get consecutive ids """
+    global _consecutive
+    if _consecutive is None:
+        try:
+            mode = run_sql("SELECT @@innodb_autoinc_lock_mode")[0][0]
+            _consecutive = int(mode) != 2
+        except Exception:
+            # not InnoDB, or too old to have the setting; both lock the
+            # table for the statement
+            _consecutive = True
+    return _consecutive
+
+
+def _read_block(fd):
+    """
+    Returns the next id of the current block and its end, read from the
+    file fd, or twice 0 if there is no block.
+    """
+    try:
+        next_id, end = [int(n) for n in os.read(fd, 64).split()]
+    except ValueError:
+        # no block yet, or the file has been damaged
+        return 0, 0
+    return next_id, end
+
+
+def _uses_blocks():
+    """ Returns True if ids are taken from reserved blocks """
+    return CFG_SIMPLESTORE_RECID_BLOCK_SIZE > 1 and _inserts_are_consecutive()
+
+
+def new_recid():
+    """
+    Returns a new record id, whose row in bibrec already exists.
+    """
+    size = CFG_SIMPLESTORE_RECID_BLOCK_SIZE
+    if not _uses_blocks():
+        return reserve_block(1)
+    with _lock:
+        fd = os.open(CFG_SIMPLESTORE_RECID_FILE, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            next_id, end = _read_block(fd)
+            reserved = next_id >= end
+            if reserved:
+                next_id = reserve_block(size)
+                end = next_id + size
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%d %d' % (next_id + 1, end))
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+    if not reserved:
+        # the row was created with its block, the record only now
+        run_sql("UPDATE bibrec SET creation_date=NOW(), "
+                "modification_date=NOW() WHERE id=%s", (next_id, ))
+    return next_id
+
+
+def peek_recid():
+    """
+    Returns the record id new_recid would hand out next, without taking
+    it, e.g. for a dry run of bibupload.
+    """
+    if _uses_blocks():
+        try:
+            fd = os.open(CFG_SIMPLESTORE_RECID_FILE, os.O_RDONLY)
+        except OSError:
+            pass
+        else:
+            try:
+                next_id, end = _read_block(fd)
+            finally:
+                os.close(fd)
+            if next_id < end:
+                return next_id
+    return run_sql("SELECT max(id)+1 FROM bibrec")[0][0]
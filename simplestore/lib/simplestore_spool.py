@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore bibupload Spool
+
+Collects the records of finalized deposits, so that they are handed to
+bibupload together: the spool is flushed, as one MARCXML collection and
+one bibupload task, once it holds CFG_SIMPLESTORE_SPOOL_MAX_RECORDS
+records or its oldest record has waited CFG_SIMPLESTORE_SPOOL_MAX_DELAY
+seconds, whichever comes first.
+
+Every record is a file of CFG_SIMPLESTORE_SPOOL_FOLDER named after its
+sub_id, so the spool is shared by all processes and survives restarts.
+It is flushed under a lockf lock by whichever process finds it full or
+due: the one adding a record, a timer of a process which added one, a
+status request, or the janitor. The timer goes with its process, so the
+spool is submitted within CFG_SIMPLESTORE_SPOOL_MAX_DELAY seconds only
+while that process lives or status requests come in, e.g. from the page
+of a depositor waiting for a record; otherwise the interval of the
+janitor is the bound. Once submitted, the bibupload task id is recorded
+in the manifest of every submission of the batch.
+"""
+import os
+import time
+import fcntl
+import threading
+from tempfile import mkstemp
+
+from flask import current_app
+
+from invenio.config import CFG_TMPSHAREDDIR
+from invenio.bibtask import task_low_level_submission
+from invenio.simplestore_upload_handler import get_upload_dir
+import invenio.simplestore_manifest as manifest
+
+# If CFG_SIMPLESTORE_SPOOL_FOLDER is not found in invenio-local.conf,
+# default is a directory of the shared temporary folder
+try:
+    from invenio.config import CFG_SIMPLESTORE_SPOOL_FOLDER
+except ImportError:
+    CFG_SIMPLESTORE_SPOOL_FOLDER = os.path.join(CFG_TMPSHAREDDIR,
+                                                'simplestore_spool')
+
+# If CFG_SIMPLESTORE_SPOOL_MAX_RECORDS is not found in invenio-local.conf,
+# default is to submit 50 records at a time. 1 submits every record at once
+try:
+    from invenio.config import CFG_SIMPLESTORE_SPOOL_MAX_RECORDS
+except ImportError:
+    CFG_SIMPLESTORE_SPOOL_MAX_RECORDS = 50
+
+# If CFG_SIMPLESTORE_SPOOL_MAX_DELAY is not found in invenio-local.conf,
+# default is to keep a record in the spool for at most 30 seconds
+try:
+    from invenio.config import CFG_SIMPLESTORE_SPOOL_MAX_DELAY
+except ImportError:
+    CFG_SIMPLESTORE_SPOOL_MAX_DELAY = 30
+
+LOCK_FILENAME = '.lock'
+RECORD_SUFFIX = '.xml'
+
+# timer of this process flushing the spool once its records are due
+_timer = None
+_timer_lock = threading.Lock()
+_flush_lock = threading.Lock()
+
+
+def _record_path(sub_id):
+    return os.path.join(CFG_SIMPLESTORE_SPOOL_FOLDER, sub_id + RECORD_SUFFIX)
+
+
+def add(sub_id, marc):
+    """
+    Adds the MARCXML record of submission sub_id to the spool, and flushes
+    the spool if it is full. Returns the bibupload task id if the record
+    has been submitted already, otherwise None.
+
+    Only errors that keep the record out of the spool are raised: once
+    spooled, the record is submitted by a later flush should this one
+    fail.
+    """
+    try:
+        os.makedirs(CFG_SIMPLESTORE_SPOOL_FOLDER)
+    except OSError:
+        if not os.path.isdir(CFG_SIMPLESTORE_SPOOL_FOLDER):
+            raise
+    path = _record_path(sub_id)
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(marc.encode('utf8'))
+    # the record is spooled and counted once it has its final name
+    os.rename(tmp_path, path)
+    try:
+        task_id = flush()
+    except Exception:
+        current_app.logger.exception("Flushing the spool failed, %s stays "
+                                     "spooled" % sub_id)
+        task_id = None
+    if task_id is None:
+        _schedule_flush(CFG_SIMPLESTORE_SPOOL_MAX_DELAY)
+    return task_id
+
+
+def spooled_records():
+    """
+    Returns the sub_ids of the records in the spool, oldest first, and the
+    time the oldest one was added, or None if the spool is empty.
+    """
+    try:
+        names = os.listdir(CFG_SIMPLESTORE_SPOOL_FOLDER)
+    except OSError:
+        return [], None
+    records = []
+    for name in names:
+        if not name.endswith(RECORD_SUFFIX):
+            continue
+        try:
+            mtime = os.path.getmtime(os.path.join(CFG_SIMPLESTORE_SPOOL_FOLDER,
+                                                  name))
+        except OSError:
+            # flushed meanwhile
+            continue
+        records.append((mtime, name[:-len(RECORD_SUFFIX)]))
+    records.sort()
+    if not records:
+        return [], None
+    return [sub_id for added, sub_id in records], records[0][0]
+
+
+def _is_due(sub_ids, oldest):
+    """ Returns True if the spooled records have to be submitted now """
+    return (len(sub_ids) >= CFG_SIMPLESTORE_SPOOL_MAX_RECORDS or
+            time.time() - oldest >= CFG_SIMPLESTORE_SPOOL_MAX_DELAY)
+
+
+def flush(force=False):
+    """
+    Submits the spooled records to bibupload in one task if the spool is
+    full or its oldest record has waited long enough, or if force is set.
+    Returns the id of the task, or None if nothing was submitted.
+    """
+    sub_ids, oldest = spooled_records()
+    if not sub_ids or not (force or _is_due(sub_ids, oldest)):
+        return None
+    # lockf only excludes other processes
+    with _flush_lock:
+        lock = open(os.path.join(CFG_SIMPLESTORE_SPOOL_FOLDER, LOCK_FILENAME),
+                    'a')
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            # another one may have flushed while we waited for the lock
+            sub_ids, oldest = spooled_records()
+            if not sub_ids or not (force or _is_due(sub_ids, oldest)):
+                return None
+            records = []
+            for sub_id in sub_ids:
+                with open(_record_path(sub_id), 'rb') as fp:
+                    records.append(fp.read().decode('utf8'))
+            task_id = submit(records)
+            # should we die here, the records are submitted again, which
+            # replaces them with themselves
+            for sub_id in sub_ids:
+                os.remove(_record_path(sub_id))
+                # the janitor keeps the uploads until bibupload had time
+                # to run
+                manifest.update_job(get_upload_dir(sub_id), 'done',
+                                    state='submitted', task_id=task_id)
+            return task_id
+        finally:
+            # closing the file releases the lock
+            lock.close()
+
+
+def submit(records):
+    """
+    Submits a list of MARCXML records to bibupload as one collection, in
+    a single task, and returns the id of the task.
+    """
+    collection = u'<collection xmlns="http://www.loc.gov/MARC21/slim">\n' + \
+                 u'\n'.join(records) + u'\n</collection>'
+    tmp_file = write_marc_to_temp_file(collection)
+    return task_low_level_submission('bibupload', 'webdeposit', '-r',
+                                     tmp_file)
+
+
+def write_marc_to_temp_file(marc):
+    """
+    Writes out the MARCXML to a file.
+    """
+    tmp_file_fd, tmp_file_name = mkstemp(
+        suffix='.marcxml',
+        prefix="webdeposit_%s" % time.strftime("%Y-%m-%d_%H:%M:%S"),
+        dir=CFG_TMPSHAREDDIR)
+
+    os.write(tmp_file_fd, marc.encode('utf8'))
+    os.close(tmp_file_fd)
+    os.chmod(tmp_file_name, 0644)
+
+    return tmp_file_name
+
+
+def _schedule_flush(delay):
+    """
+    Makes sure this process flushes the spool within delay seconds, unless
+    it is flushed by another one.
+    """
+    global _timer
+    with _timer_lock:
+        if _timer is not None:
+            return
+        _timer = threading.Timer(delay, _timed_flush)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _timed_flush():
+    """ Flushes the spool if due, and waits for the next records if any """
+    global _timer
+    with _timer_lock:
+        _timer = None
+    try:
+        flush()
+    finally:
+        sub_ids, oldest = spooled_records()
+        if sub_ids:
+            _schedule_flush(max(0, oldest + CFG_SIMPLESTORE_SPOOL_MAX_DELAY -
+                                time.time()) + 0.1)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+## This file is part of SimpleStore.
+## Copyright (C) 2013 EPCC, The University of Edinburgh.
+##
+## SimpleStore is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## SimpleStore is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with SimpleStore; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+SimpleStore Typeahead
+
+Serves the suggestions of typeahead fields whose list of values is too long
+to be put into the form, such as the ISO 639-3 language codes. The widget
+asks for the values matching what has been typed so far and gets a short
+JSON list back.
+
+A value matches if the query is a prefix of the value, or of the part of
+the value starting at one of its words, ignoring case; e.g. 'ara', 'arabic'
+and 'saharan ar' all match 'aao Algerian Saharan Arabic'. Every source is
+indexed on first use as a sorted list of these keys, so a lookup is a
+binary search.
+"""
+import bisect
+import threading
+
+from flask import jsonify
+
+# number of suggestions returned if the client does not ask for a number
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# seconds browsers may reuse the suggestions for a query
+CACHE_MAX_AGE = 24 * 3600
+
+
+def _lang_codes():
+    from invenio.simplestore_model.metadata.linguistics_lang_codes import \
+        lang_codes
+    return lang_codes
+
+# functions returning the values of each source, by the name used in the
+# 'data_remote' argument of a metadata field
+SOURCES = {'lang_codes': _lang_codes}
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _decode(value):
+    """
+    Returns value as unicode. The values were written to be embedded in
+    an HTML attribute and may contain &apos; entities, which are undone.
+    """
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return value.replace(u'&apos;', u"'")
+
+
+def build_index(values):
+    """
+    Returns the index of a list of values: a tuple of the sorted list of
+    keys, the list of positions in values of the value of every key and
+    the values themselves.
+    """
+    values = [_decode(v) for v in values]
+    pairs = []
+    for position, value in enumerate(values):
+        words = value.lower().split()
+        for i in range(len(words)):
+            pairs.append((u' '.join(words[i:]), position))
+    pairs.sort()
+    return [k for k, p in pairs], [p for k, p in pairs], values
+
+
+def get_index(source):
+    """ Returns the index of source, or None if there is no such source """
+    index = _indexes.get(source)
+    if index is None:
+        if source not in SOURCES:
+            return None
+        with _indexes_lock:
+            index = _indexes.get(source)
+            if index is None:
+                index = build_index(SOURCES[source]())
+                _indexes[source] = index
+    return index
+
+
+def search(index, query, limit=DEFAULT_LIMIT):
+    """
+    Returns at most limit values of index matching query, in the order of
+    the keys they match.
+    """
+    keys, positions, values = index
+    query = u' '.join(query.lower().split())
+    if not query:
+        return []
+    found = []
+    seen = set()
+    i = bisect.bisect_left(keys, query)
+    while i < len(keys) and len(found) < limit and \
+            keys[i].startswith(query):
+        if positions[i] not in seen:
+            seen.add(positions[i])
+            found.append(values[positions[i]])
+        i += 1
+    return found
+
+
+def typeahead(request, source):
+    """
+    Returns the values of source matching the query in the 'q' argument,
+    as a JSON list under 'values'. The number of values can be set with
+    the 'limit' argument.
+    """
+    index = get_index(source)
+    if index is None:
+        rv = jsonify(error="Unknown source %s" % source)
+        rv.status_code = 404
+        return rv
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    rv = jsonify(values=search(index, request.args.get('q', u''), limit))
+    rv.headers['Cache-Control'] = 'private, max-age=%d' % CACHE_MAX_AGE
+    return rv
@@ -23,19 +23,156 @@ SimpleStore File Upload
 Functions to handle plupload js calls from deposit page.
 Based on WebDeposit code.
 """
-import shutil
 import os
+import errno
+import time
+import hashlib
+import hmac
+import threading
+import re
+from calendar import timegm
+from functools import wraps
 from uuid import uuid1 as new_uuid
-from glob import iglob
-import pickle
 
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import parse_range_header, parse_if_range_header
 
-from flask import send_file
+from flask import current_app, jsonify
 
-from invenio.config import CFG_SIMPLESTORE_UPLOAD_FOLDER
+from invenio.config import CFG_SIMPLESTORE_UPLOAD_FOLDER, CFG_SITE_SECRET_KEY
+from invenio.webuser_flask import current_user
+import invenio.simplestore_manifest as manifest
+import invenio.simplestore_blobstore as blobstore
+import invenio.simplestore_ingest as ingest
+import invenio.simplestore_archive as archive
+import invenio.simplestore_quota as quota
 
+# If CFG_SIMPLESTORE_UPLOAD_INPLACE is not found in invenio-local.conf,
+# default is to write chunks straight into a single preallocated file
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_INPLACE
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_INPLACE = True
 
+# If CFG_SIMPLESTORE_UPLOAD_FOLDER_FANOUT is not found in invenio-local.conf,
+# default is to keep every submission directly in the upload folder
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_FOLDER_FANOUT
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_FOLDER_FANOUT = 0
+
+# If CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE is not found in invenio-local.conf,
+# default is to send files in chunks of at least 1 MB
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# If CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE is not found in invenio-local.conf,
+# default is to send files in chunks of at most 32 MB
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE = 32 * 1024 * 1024
+
+# If CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS is not found in invenio-local.conf,
+# default is to size chunks so that sending one takes at most 5 seconds
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS = 5
+
+# If CFG_SIMPLESTORE_STATUS_MAX_WAIT is not found in invenio-local.conf,
+# default is to hold a status request for at most 20 seconds until the
+# submission changes
+try:
+    from invenio.config import CFG_SIMPLESTORE_STATUS_MAX_WAIT
+except ImportError:
+    CFG_SIMPLESTORE_STATUS_MAX_WAIT = 20
+
+# If CFG_SIMPLESTORE_UPLOAD_EXTRACT is not found in invenio-local.conf,
+# default is to store archives as they are, even if the depositor asks
+# for their files to be extracted
+try:
+    from invenio.config import CFG_SIMPLESTORE_UPLOAD_EXTRACT
+except ImportError:
+    CFG_SIMPLESTORE_UPLOAD_EXTRACT = False
+
+# If CFG_SIMPLESTORE_DOWNLOAD_ACCEL is not found in invenio-local.conf,
+# default is to send uploaded files from Python. It can be set to
+# 'X-Sendfile' (Apache mod_xsendfile, lighttpd) or 'X-Accel-Redirect' (nginx)
+# to have the front-end web server do the transfer
+try:
+    from invenio.config import CFG_SIMPLESTORE_DOWNLOAD_ACCEL
+except ImportError:
+    CFG_SIMPLESTORE_DOWNLOAD_ACCEL = None
+
+# If CFG_SIMPLESTORE_DOWNLOAD_ACCEL_PREFIX is not found in invenio-local.conf,
+# default is this internal nginx location, aliased to the upload folder
+try:
+    from invenio.config import CFG_SIMPLESTORE_DOWNLOAD_ACCEL_PREFIX
+except ImportError:
+    CFG_SIMPLESTORE_DOWNLOAD_ACCEL_PREFIX = '/simplestore-uploads/'
+
+# suffix of a file that is still being assembled from its chunks
+PARTIAL_SUFFIX = '.part'
+# size of the buffer used when copying a chunk to disk
+COPY_BUFFER_SIZE = 64 * 1024
+# seconds between two looks at the manifest of a waiting status request
+STATUS_POLL_INTERVAL = 0.25
+# number of chunks a file is split into, unless that makes the chunks
+# smaller than CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE
+CHUNKS_PER_FILE = 64
+# maximum number of files this process keeps a running ingest pipeline for
+MAX_INGEST_STATES = 256
+
+# number and size of the byte ranges of a file a client has to hash to
+# prove it has the file, and seconds it has to do so
+PROOF_RANGES = 4
+PROOF_RANGE_SIZE = 4096
+PROOF_TIMEOUT = 600
+
+# a SHA-256 hex digest as sent by clients
+SHA256_RE = re.compile('^[0-9a-f]{64}$')
+# a submission id, i.e. a uuid
+SUB_ID_RE = re.compile('^[0-9A-Za-z_-]+$')
+# a submission id as handed out by the deposit page, a uuid with or
+# without dashes
+UUID_RE = re.compile('^[0-9a-f]{8}(-?[0-9a-f]{4}){3}-?[0-9a-f]{12}$')
+# number of characters of the submission id naming a fan-out directory
+FANOUT_WIDTH = 2
+
+# running ingest pipelines of the files being assembled by this process,
+# keyed by the path of the part file
+_ingest_states = {}
+_ingest_states_lock = threading.Lock()
+
+
+def _throttled(handler):
+    """
+    Decorates an upload handler to run only within the upload quotas of
+    the current user, answering 429 with a Retry-After header otherwise.
+    The body of the request is not read in that case.
+    """
+    @wraps(handler)
+    def throttled_handler(request, sub_id):
+        try:
+            slots = quota.acquire(current_user.get_id(),
+                                  request.content_length or 0)
+        except quota.QuotaExceeded as e:
+            rv = jsonify(error=str(e), retry_after=e.retry_after)
+            rv.status_code = 429
+            rv.headers['Retry-After'] = str(e.retry_after)
+            return rv
+        try:
+            return handler(request, sub_id)
+        finally:
+            quota.release(slots)
+    return throttled_handler
+
+
+@_throttled
 def upload(request, sub_id):
     """ The file is split into chunks on the client-side
         and reformed on the server-side.
@@ -43,9 +180,9 @@ def upload(request, sub_id):
         @sub_id - submission id
     """
     if request.method == 'POST':
-        if sub_id.startswith('/'):
-            # malformed uuid, can lead to data escalation, raise an error
-            raise Exception('UUID is malformed')
+        # the form is parsed on first access, so this includes
+        # receiving the chunk
+        started = time.time()
         try:
             chunks = request.form['chunks']
             chunk = request.form['chunk']
@@ -56,60 +193,910 @@ def upload(request, sub_id):
         name = request.form['name']
         current_chunk = request.files['file']
 
-        try:
-            filename = secure_filename(name) + "_" + chunk
-        except UnboundLocalError:
-            filename = secure_filename(name)
+        upload_dir = _prepare_upload_dir(sub_id)
+        extract = _wants_extraction(request.form, name)
 
-        if not os.path.exists(CFG_SIMPLESTORE_UPLOAD_FOLDER):
-            os.makedirs(CFG_SIMPLESTORE_UPLOAD_FOLDER)
+        if chunks is None:  # file is a single chunk
+            return _store_single(upload_dir, name, current_chunk.stream,
+                                 extract)
 
-        # webdeposit also adds userid and deptype folders, we just use unique id
-        upload_dir = os.path.join(CFG_SIMPLESTORE_UPLOAD_FOLDER, sub_id)
+        if _is_inplace_request(request):
+            return _store_chunk_inplace(upload_dir, name, chunk, chunks,
+                                        request.form['chunk_size'],
+                                        request.form['total_size'],
+                                        current_chunk.stream, extract,
+                                        started)
 
-        if not os.path.exists(upload_dir):
-            os.makedirs(upload_dir)
+        try:
+            if not 0 <= int(chunk) < int(chunks):
+                return "Chunk " + chunk + " is out of range", 400
+        except ValueError:
+            return "Chunk parameters must be integers", 400
 
-        # Save the chunk
+        # Save the chunk, feeding it to the ingest pipeline of the file
+        # if it is the next one in order
+        filename = secure_filename(name) + "_" + chunk
         path_to_save = os.path.join(upload_dir, filename)
-        current_chunk.save(path_to_save)
+        ingest_key = _ingest_key(os.path.join(upload_dir,
+                                              secure_filename(name)),
+                                 chunks)
+        state = _claim_ingest_state(ingest_key, int(chunk))
+        try:
+            with open(path_to_save, 'wb') as destination:
+                size = _copy_stream(current_chunk.stream, destination,
+                                    state and state['pipeline'])
+        except:
+            if state is not None:
+                _release_ingest_state(ingest_key, state, None)
+            raise
+        if state is not None:
+            _release_ingest_state(ingest_key, state, 1)
+        entry, last = manifest.record_chunk(upload_dir,
+                                            secure_filename(name), name,
+                                            int(chunk), int(chunks), size,
+                                            elapsed=time.time() - started)
 
-        if chunks is None:  # file is a single chunk
-            unique_filename = str(new_uuid())
-            old_path = os.path.join(upload_dir, filename)
-            file_path = os.path.join(upload_dir,
-                                     unique_filename)
-            os.rename(old_path, file_path)  # Rename the chunk
-            size = os.path.getsize(file_path)
-            file_metadata = dict(name=name, file=file_path, size=size)
-        elif (chunks is not None) and (int(chunk) == int(chunks) - 1):
+        if last:
             '''All chunks have been uploaded!
                 start merging the chunks'''
             filename = secure_filename(name)
-            chunk_files = []
-            for chunk_file in iglob(os.path.join(upload_dir,
-                                                 filename + '_*')):
-                chunk_files.append(chunk_file)
-
-            # Sort files in numerical order
-            chunk_files.sort(key=lambda x: int(x.split("_")[-1]))
-
-            file_uuid = str(new_uuid())
-            file_path = os.path.join(upload_dir, file_uuid)
-            metadata_file_path = os.path.join(upload_dir, 'metadata_' + file_uuid + filename)
-            destination = open(file_path, 'wb')
-            for chunk in chunk_files:
-                shutil.copyfileobj(open(chunk, 'rb'), destination)
-                os.remove(chunk)
-            destination.close()
-            size = os.path.getsize(file_path)
-            file_metadata = dict(name=name, file=file_path, size=size)
-            # create a metadata-<uuid>-<safe-file-name> file to store pickled metadata
-            pickle.dump(file_metadata, open(metadata_file_path, 'wb'))
+            # chunk files in numerical order
+            chunk_files = [os.path.join(upload_dir, filename + '_' + str(i))
+                           for i in range(int(chunks))]
+            try:
+                return _assemble_chunks(upload_dir, name, filename,
+                                        chunk_files, ingest_key, extract)
+            except:
+                _assembly_failed(upload_dir, filename, chunk_files)
+                raise
+
+    return filename
+
+
+def _assemble_chunks(upload_dir, name, filename, chunk_files, ingest_key,
+                     extract=False):
+    """
+    Merges the chunk files of a complete upload into the final file and
+    records it, or extracts it if extract is set. Returns the response to
+    the upload request.
+    """
+    file_uuid = str(new_uuid())
+    file_path = os.path.join(upload_dir, file_uuid)
+    state = _pop_ingest_state(ingest_key)
+    try:
+        if extract:
+            part_path = file_path + PARTIAL_SUFFIX
+            try:
+                _concatenate(chunk_files, part_path)
+            except:
+                _remove_if_exists(part_path)
+                raise
+            return _extract_stored_archive(upload_dir, name, part_path)
+        if state is not None and state['offset'] == len(chunk_files):
+            # everything has been ingested, the kernel can do the copying
+            pipeline = state['pipeline']
+            if len(chunk_files) == 1:
+                os.rename(chunk_files[0], file_path)
+            else:
+                _concatenate(chunk_files, file_path)
+        else:
+            # the chunks are read anyway, so ingest them on the way
+            pipeline = ingest.new_pipeline()
+            _concatenate(chunk_files, file_path, pipeline)
+        _record_file(upload_dir, filename, name, file_path,
+                     pipeline.results())
+    except:
+        _remove_if_exists(file_path)
+        raise
+    return filename
+
+
+def _assembly_failed(upload_dir, filename, sources):
+    """
+    Lets the next chunk sent for file filename, whose assembly has failed,
+    assemble it again. If the chunks in the files sources are not all there
+    any more, the whole file has to be sent again.
+    """
+    lost = not all(os.path.exists(path) for path in sources)
+    manifest.assembly_failed(upload_dir, filename, lost)
+
+
+def _remove_if_exists(path):
+    """ Removes the file at path, unless there is no such file """
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+@_throttled
+def upload_raw(request, sub_id):
+    """
+    Same as upload(), but the chunk is the raw request body and the
+    parameters are passed in the query string, as plupload does when
+    multipart is switched off.
+
+    The body is read from the socket in blocks of COPY_BUFFER_SIZE and
+    written straight to its final place, instead of being spooled by the
+    form parser first and copied afterwards. Chunked raw uploads are always
+    assembled in place, so they need chunk_size and total_size.
+
+        @sub_id - submission id
+    """
+    started = time.time()
+    args = request.args
+    name = args.get('name')
+    if not name:
+        return "File name missing", 400
+
+    upload_dir = _prepare_upload_dir(sub_id)
+    extract = _wants_extraction(args, name)
+
+    if 'chunks' not in args:
+        return _store_single(upload_dir, name, request.stream, extract)
+
+    if 'chunk' not in args:
+        return "Chunk missing", 400
+    if 'chunk_size' not in args or 'total_size' not in args:
+        return "Chunk size and total size are required", 400
+    return _store_chunk_inplace(upload_dir, name,
+                                args['chunk'], args['chunks'],
+                                args['chunk_size'], args['total_size'],
+                                request.stream, extract, started)
+
+
+def upload_precheck(request, sub_id):
+    """
+    Lets the client announce a file by its size and SHA-256 before sending
+    it. If the blob store already holds identical content, the file is added
+    to the submission straight away and no bytes have to be uploaded.
+
+    Knowing the checksum of a file is not the same as having it, so the
+    client has to prove it has the content: the first request is answered
+    with a nonce and byte ranges of the file chosen by the server, and the
+    request has to be sent again with the nonce and, as proof, the SHA-256
+    hex digest of the bytes of those ranges, in order.
+
+    Answers with exists=True and the name to use for the file if the proof
+    holds, otherwise with exists=False and the client uploads the file as
+    usual; the answer to the first request is exists=False as well, along
+    with the nonce and ranges.
+    """
+    name = request.form.get('name')
+    sha256 = request.form.get('sha256', '').lower()
+    try:
+        size = int(request.form.get('size'))
+    except (TypeError, ValueError):
+        return "Invalid size", 400
+    if not name or not SHA256_RE.match(sha256):
+        return "Invalid file name or checksum", 400
+    if not blobstore.is_enabled():
+        return jsonify(exists=False)
+
+    # the challenge does not tell whether the content is known
+    nonce = request.form.get('nonce')
+    if not nonce:
+        nonce = _new_nonce(sub_id, sha256, size)
+        return jsonify(exists=False, nonce=nonce,
+                       ranges=_proof_ranges(sub_id, sha256, size, nonce))
+    if not _valid_nonce(nonce, sub_id, sha256, size):
+        return "Invalid or expired nonce", 400
+
+    blob = blobstore.find_blob(sha256, size)
+    if blob is None:
+        return jsonify(exists=False)
+    try:
+        proof = _possession_proof(blob, _proof_ranges(sub_id, sha256, size,
+                                                      nonce))
+    except (IOError, OSError):
+        # the blob has just been collected
+        return jsonify(exists=False)
+    claimed = request.form.get('proof', '').lower()
+    if not SHA256_RE.match(claimed) or not _compare_digest(proof, claimed):
+        return jsonify(exists=False)
+
+    upload_dir = _prepare_upload_dir(sub_id)
+    filename = secure_filename(name)
+    file_path = os.path.join(upload_dir, str(new_uuid()))
+    try:
+        blobstore.link_blob(blob, file_path)
+    except OSError:
+        # the blob has just been collected, the client has to upload it
+        return jsonify(exists=False)
+    manifest.record_file(upload_dir, filename, name, file_path, size, sha256)
+    return jsonify(exists=True, filename=filename)
+
+
+def _sign(*values):
+    """ Returns the HMAC of values, keyed with the secret of the site """
+    return hmac.new(CFG_SITE_SECRET_KEY, ':'.join(str(v) for v in values),
+                    hashlib.sha256).hexdigest()
+
+
+def _new_nonce(sub_id, sha256, size):
+    """
+    Returns a nonce for a proof of possession of the file of the given
+    checksum and size, valid for submission sub_id only. Nonces are signed,
+    so that a client cannot pick one whose ranges it happens to know.
+    """
+    issued = '%x' % int(time.time())
+    salt = os.urandom(8).encode('hex')
+    return '%s.%s.%s' % (issued, salt,
+                         _sign(sub_id, sha256, size, issued, salt))
+
+
+def _valid_nonce(nonce, sub_id, sha256, size):
+    """
+    Returns True if nonce has been issued by _new_nonce for these arguments
+    less than PROOF_TIMEOUT seconds ago.
+    """
+    try:
+        issued, salt, signature = str(nonce).split('.')
+        age = time.time() - int(issued, 16)
+    except (ValueError, UnicodeError):
+        return False
+    return (0 <= age < PROOF_TIMEOUT and
+            _compare_digest(signature,
+                            _sign(sub_id, sha256, size, issued, salt)))
+
+
+def _proof_ranges(sub_id, sha256, size, nonce):
+    """
+    Returns the byte ranges, as [start, end] lists, of the file whose bytes
+    prove possession of it for the given nonce.
+    """
+    ranges = []
+    for i in range(PROOF_RANGES if size > 0 else 0):
+        start = int(_sign(sub_id, sha256, size, nonce, i)[:12], 16) % size
+        ranges.append([start, min(start + PROOF_RANGE_SIZE, size)])
+    return ranges
+
+
+def _possession_proof(path, ranges):
+    """
+    Returns the SHA-256 hex digest of the bytes of the file at path in the
+    given ranges, in order.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for start, end in ranges:
+            fp.seek(start)
+            sha.update(fp.read(end - start))
+    return sha.hexdigest()
+
+
+def _compare_digest(a, b):
+    """ Compares two digests in constant time, where Python allows it """
+    compare = getattr(hmac, 'compare_digest', None)
+    if compare is not None:
+        return compare(str(a), str(b))
+    return a == b
+
+
+def get_upload_dir(sub_id, fanout=None):
+    """
+    Returns the directory of submission sub_id. With a fan-out, the
+    submission is kept fanout levels below the upload folder, in
+    directories named after successive pairs of characters of sub_id,
+    e.g. 4f/a2/4fa21e3c-... for a fan-out of 2.
+
+    @fanout - number of levels, CFG_SIMPLESTORE_UPLOAD_FOLDER_FANOUT
+              if not given
+    """
+    if not SUB_ID_RE.match(sub_id):
+        # malformed uuid, can lead to data escalation, raise an error
+        raise Exception('UUID is malformed')
+    if fanout is None:
+        fanout = CFG_SIMPLESTORE_UPLOAD_FOLDER_FANOUT
+    levels = [sub_id[i * FANOUT_WIDTH:(i + 1) * FANOUT_WIDTH]
+              for i in range(fanout)]
+    return os.path.join(CFG_SIMPLESTORE_UPLOAD_FOLDER, *(levels + [sub_id]))
+
+
+def iter_upload_dirs(folder=CFG_SIMPLESTORE_UPLOAD_FOLDER):
+    """
+    Yields a tuple of the submission id and directory of every submission
+    in the upload folder, whatever fan-out it has been stored with.
+    Fan-out directories are told apart by their short names. Only
+    directories named like a uuid are submissions; anything else, such as
+    the quota slots or a blob store kept in the upload folder, is left out.
+    """
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        if len(name) == FANOUT_WIDTH:
+            for sub in iter_upload_dirs(path):
+                yield sub
+        elif UUID_RE.match(name):
+            yield name, path
+
+
+def migrate_upload_folder():
+    """
+    Moves every submission to where get_upload_dir expects it, e.g. after
+    CFG_SIMPLESTORE_UPLOAD_FOLDER_FANOUT has been changed, and removes the
+    fan-out directories left empty. Returns the number of submissions moved.
+    """
+    moved = 0
+    for sub_id, upload_dir in list(iter_upload_dirs()):
+        target = get_upload_dir(sub_id)
+        if upload_dir == target:
+            continue
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.rename(upload_dir, target)
+        moved += 1
+    for dirpath, dirnames, filenames in os.walk(CFG_SIMPLESTORE_UPLOAD_FOLDER,
+                                                topdown=False):
+        if (dirpath != CFG_SIMPLESTORE_UPLOAD_FOLDER and
+                len(os.path.basename(dirpath)) == FANOUT_WIDTH):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # not empty
+                pass
+    return moved
+
+
+def _prepare_upload_dir(sub_id):
+    """
+    Returns the upload directory of submission sub_id, creating it if
+    it does not exist yet.
+    """
+    # webdeposit also adds userid and deptype folders, we just use unique id
+    upload_dir = get_upload_dir(sub_id)
+
+    # a single mkdir in the common case of an existing directory
+    try:
+        os.mkdir(upload_dir)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            try:
+                os.makedirs(upload_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        elif e.errno != errno.EEXIST:
+            raise
+    return upload_dir
+
+
+def _store_single(upload_dir, name, stream, extract=False):
+    """
+    Stores a file that was sent in one piece under a unique name, ingesting
+    it on the way. Returns the secure name of the file.
+
+    If extract is set, the files of the archive are stored instead. A tar
+    archive is extracted straight from stream and never stored itself.
+    """
+    if extract and archive.is_tar(name):
+        return _extract_archive_response(upload_dir, name, stream)
+
+    filename = secure_filename(name)
+    file_path = os.path.join(upload_dir, str(new_uuid()))
+    part_path = file_path + PARTIAL_SUFFIX
+    if extract:
+        with open(part_path, 'wb') as destination:
+            _copy_stream(stream, destination)
+        return _extract_stored_archive(upload_dir, name, part_path)
+    pipeline = ingest.new_pipeline()
+    with open(part_path, 'wb') as destination:
+        _copy_stream(stream, destination, pipeline)
+    os.rename(part_path, file_path)
+    _record_file(upload_dir, filename, name, file_path, pipeline.results())
+    return filename
+
+
+def import_file(sub_id, path):
+    """
+    Stores a copy of the local file at path in submission sub_id, as if it
+    had been uploaded, for the command line tools. Returns the secure name
+    of the file.
+    """
+    upload_dir = _prepare_upload_dir(sub_id)
+    with open(path, 'rb') as source:
+        return _store_single(upload_dir, os.path.basename(path), source)
+
+
+def _store_chunk_inplace(upload_dir, name, chunk, chunks, chunk_size,
+                         total_size, stream, extract=False, started=None):
+    """
+    Writes a chunk read from stream straight to its offset in the part file
+    of the upload and finalises the file once all chunks are there, or
+    extracts it if extract is set. Returns the secure name of the file.
+
+        @started - time the request started, to measure the throughput
+    """
+    if started is None:
+        started = time.time()
+    filename = secure_filename(name)
+    try:
+        chunk, chunks = int(chunk), int(chunks)
+        chunk_size, total_size = int(chunk_size), int(total_size)
+    except (TypeError, ValueError):
+        return "Chunk parameters must be integers", 400
+    offset = chunk * chunk_size
+    if chunk < 0 or offset >= max(total_size, 1):
+        return "Chunk " + str(chunk) + " is out of range", 400
+    if chunk_size <= 0 or total_size < 0 or \
+            chunks != max(1, (total_size + chunk_size - 1) // chunk_size):
+        return "Chunks do not match the chunk size and total size", 400
+    if manifest.complete_upload(upload_dir, filename, chunks, chunk_size,
+                                total_size):
+        # sent again, e.g. because the response was lost: writing it would
+        # start a part file that is never completed
+        return filename
+    part_path = os.path.join(upload_dir, filename + PARTIAL_SUFFIX)
+    ingest_key = _ingest_key(part_path, chunk_size, total_size)
+    size = _save_chunk_inplace(stream, part_path, offset, total_size,
+                               ingest_key)
+    entry, last = manifest.record_chunk(upload_dir, filename, name,
+                                        chunk, chunks, size,
+                                        chunk_size, total_size,
+                                        time.time() - started)
+    if last:
+        # chunks may arrive in any order, whichever request
+        # completes the file only has to finalise it
+        try:
+            if extract:
+                _pop_ingest_state(ingest_key)
+                return _extract_stored_archive(upload_dir, name, part_path)
+            _finalise_inplace(upload_dir, name, filename, part_path,
+                              ingest_key)
+        except:
+            _assembly_failed(upload_dir, filename, [part_path])
+            raise
+    return filename
+
+
+def _wants_extraction(params, name):
+    """
+    Returns True if the files of the archive name are to be stored instead
+    of the archive, i.e. extraction is enabled and the client asked for it.
+    """
+    return (CFG_SIMPLESTORE_UPLOAD_EXTRACT and
+            params.get('extract') in ('1', 'true', 'on') and
+            archive.is_archive(name))
+
+
+def _extract_stored_archive(upload_dir, name, path):
+    """
+    Extracts the archive at path, which is removed afterwards along with
+    its manifest entry. Returns the response to the upload request.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            return _extract_archive_response(upload_dir, name, fp)
+    finally:
+        os.remove(path)
+        manifest.remove_file(upload_dir, secure_filename(name))
+
+
+def _extract_archive_response(upload_dir, name, fileobj):
+    """
+    Extracts the archive fileobj, named name, and returns the response to
+    the upload request: the secure names of the files, or an error.
+    """
+    try:
+        filenames = _extract_archive(upload_dir, name, fileobj)
+    except archive.ArchiveError as e:
+        return "Unable to extract " + name + ": " + str(e), 400
+    return jsonify(files=filenames)
+
+
+def _extract_archive(upload_dir, name, fileobj):
+    """
+    Stores every regular file of the archive fileobj as an upload of its
+    own, ingesting it on the way, and returns the secure names of the files.
+    If the archive turns out to be broken or too large, the files extracted
+    so far are removed again and ArchiveError is raised.
+
+    The files are recorded in the manifest all at once at the end, as
+    updating it for each of thousands of small files would take longer
+    than extracting them.
+    """
+    taken = set(manifest.read_manifest(upload_dir)['files'])
+    extracted = []
+    part_path = None
+    try:
+        for path, member in archive.iter_members(fileobj, name):
+            filename = _unique_filename(secure_filename(path) or 'file',
+                                        taken)
+            taken.add(filename)
+            file_path = os.path.join(upload_dir, str(new_uuid()))
+            part_path = file_path + PARTIAL_SUFFIX
+            pipeline = ingest.new_pipeline()
+            with open(part_path, 'wb') as destination:
+                _copy_stream(member, destination, pipeline)
+            os.rename(part_path, file_path)
+            part_path = None
+            results = pipeline.results()
+            results['archive'] = name
+            results['archive_path'] = path
+            blobstore.store(file_path, results['sha256'])
+            extracted.append((filename, filename, file_path, results['size'],
+                              results['sha256'], results))
+    except archive.ArchiveError:
+        if part_path is not None:
+            os.remove(part_path)
+        for filename, name, file_path, size, sha256, results in extracted:
+            os.remove(file_path)
+        raise
+    manifest.record_files(upload_dir, extracted)
+    return [f[0] for f in extracted]
 
+
+def _unique_filename(filename, taken):
+    """ Returns filename, numbered if needed to differ from those taken """
+    base, ext = os.path.splitext(filename)
+    i = 1
+    while filename in taken:
+        filename = '%s_%d%s' % (base, i, ext)
+        i += 1
     return filename
 
 
+def _is_inplace_request(request):
+    """
+    Returns True if the chunk can be written straight to its offset, i.e.
+    in-place assembly is enabled and the client told us the chunk size and
+    the total size of the file.
+    """
+    return (CFG_SIMPLESTORE_UPLOAD_INPLACE and
+            'chunk_size' in request.form and 'total_size' in request.form)
+
+
+def _save_chunk_inplace(stream, part_path, offset, total_size, ingest_key):
+    """
+    Writes the chunk read from stream at the given offset of part_path
+    and returns the number of bytes written. The chunk is fed to the
+    ingest pipeline kept under ingest_key if it extends it.
+
+    The first request to arrive creates the file and preallocates it to
+    the full size, so every chunk lands in its final place and no merge
+    step is required afterwards. A part file left by an earlier upload of
+    another size is resized.
+    """
+    try:
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+        if hasattr(os, 'posix_fallocate') and total_size > 0:
+            os.posix_fallocate(fd, 0, total_size)
+        else:
+            os.ftruncate(fd, total_size)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        fd = os.open(part_path, os.O_RDWR)
+        if os.fstat(fd).st_size != total_size:
+            os.ftruncate(fd, total_size)
+
+    # feed the chunk to the ingest pipeline of the file if it follows
+    # the bytes ingested so far
+    state = _claim_ingest_state(ingest_key, offset)
+    try:
+        with os.fdopen(fd, 'r+b') as destination:
+            destination.seek(offset)
+            written = _copy_stream(stream, destination,
+                                   state and state['pipeline'])
+    except:
+        if state is not None:
+            _release_ingest_state(ingest_key, state, None)
+        raise
+    if state is not None:
+        _release_ingest_state(ingest_key, state, written)
+    return written
+
+
+def _finalise_inplace(upload_dir, name, filename, part_path, ingest_key):
+    """
+    Turns a fully assembled part file into an upload with a unique name
+    and records it in the manifest. Whatever the ingest pipeline of the
+    file has not seen, because chunks arrived out of order, is read back.
+    """
+    state = _pop_ingest_state(ingest_key)
+    if state is not None:
+        results = ingest.ingest_file(part_path, state['pipeline'],
+                                     state['offset'])
+    else:
+        results = ingest.ingest_file(part_path)
+
+    file_uuid = str(new_uuid())
+    file_path = os.path.join(upload_dir, file_uuid)
+    os.rename(part_path, file_path)
+    try:
+        _record_file(upload_dir, filename, name, file_path, results)
+    except:
+        os.remove(file_path)
+        raise
+
+
+def _record_file(upload_dir, filename, name, file_path, results):
+    """
+    Records a complete upload and the results of its ingest pipeline in
+    the manifest, after handing it to the blob store which keeps a single
+    copy of identical content.
+    """
+    blobstore.store(file_path, results['sha256'])
+    manifest.record_file(upload_dir, filename, name, file_path,
+                         results['size'], results['sha256'], results)
+
+
+def _copy_stream(source, destination, pipeline=None):
+    """
+    Copies source to destination in blocks of COPY_BUFFER_SIZE, feeding
+    every block to pipeline as well if given. Returns the number of bytes
+    copied.
+    """
+    copied = 0
+    while True:
+        block = source.read(COPY_BUFFER_SIZE)
+        if not block:
+            break
+        destination.write(block)
+        if pipeline is not None:
+            pipeline.update(block)
+        copied += len(block)
+    return copied
+
+
+def _concatenate(sources, file_path, pipeline=None):
+    """
+    Writes the concatenation of the files sources to file_path and removes
+    them. Unless the data has to be fed to pipeline on the way, it is
+    copied inside the kernel where the platform allows it.
+    """
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        for source_path in sources:
+            with open(source_path, 'rb') as source:
+                if pipeline is not None or not _kernel_copy(
+                        source.fileno(), fd, os.fstat(source.fileno()).st_size):
+                    with os.fdopen(os.dup(fd), 'wb') as destination:
+                        _copy_stream(source, destination, pipeline)
+            os.remove(source_path)
+    finally:
+        os.close(fd)
+
+
+def _kernel_copy(src, dst, count):
+    """
+    Copies count bytes from file descriptor src to file descriptor dst with
+    copy_file_range or sendfile, so the data never enters user space.
+    Returns False, having copied nothing, if neither is available or the
+    file systems involved do not support them.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if copy_file_range is None and sendfile is None:
+        return False
+    copied = 0
+    while copied < count:
+        try:
+            if copy_file_range is not None:
+                n = copy_file_range(src, dst, count - copied)
+            else:
+                n = sendfile(dst, src, None, count - copied)
+        except OSError as e:
+            if copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS,
+                                           errno.EINVAL, errno.EOPNOTSUPP):
+                return False
+            raise
+        if n == 0:
+            break
+        copied += n
+    return True
+
+
+def _ingest_key(path, *params):
+    """
+    Returns the key of the ingest state of the upload of the file at path
+    with the given chunking parameters. Another upload of the same file,
+    chunked differently, does not continue the pipeline of the first one.
+    """
+    return '%s:%s' % (path, ':'.join(str(p) for p in params))
+
+
+def _claim_ingest_state(key, position):
+    """
+    Returns the running ingest state of file key if it covers exactly the
+    data before position and no other request is extending it, otherwise
+    None. A new state is started at position 0. The position is the byte
+    offset for files assembled in place, and the chunk index for files
+    stored as separate chunks.
+
+    Chunks that cannot extend the pipeline are simply not ingested; the
+    missing part is read back from disk when the file is finalised.
+    """
+    with _ingest_states_lock:
+        state = _ingest_states.get(key)
+        if state is None and position == 0:
+            if len(_ingest_states) >= MAX_INGEST_STATES:
+                # forget the file that has been idle for the longest time
+                oldest = min(_ingest_states,
+                             key=lambda k: _ingest_states[k]['touched'])
+                del _ingest_states[oldest]
+            state = dict(pipeline=ingest.new_pipeline(), offset=0, busy=False)
+            _ingest_states[key] = state
+        if state is None or state['busy'] or state['offset'] != position:
+            return None
+        state['busy'] = True
+        state['touched'] = time.time()
+        return state
+
+
+def _release_ingest_state(key, state, advance):
+    """
+    Releases a state taken with _claim_ingest_state, moving its position on
+    by advance. If advance is None the write failed and the state, which
+    may now be inconsistent, is dropped.
+    """
+    with _ingest_states_lock:
+        if advance is None:
+            if _ingest_states.get(key) is state:
+                del _ingest_states[key]
+        else:
+            state['offset'] += advance
+            state['busy'] = False
+
+
+def _pop_ingest_state(key):
+    """ Returns and forgets the running ingest state of file key, if any """
+    with _ingest_states_lock:
+        return _ingest_states.pop(key, None)
+
+
+def file_sha256(path, sha=None, offset=0):
+    """
+    Returns the SHA-256 hex digest of the file at path. If sha is given it
+    must already contain the first offset bytes of the file, and only the
+    rest of the file is read.
+    """
+    if sha is None:
+        sha = hashlib.sha256()
+        offset = 0
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        while True:
+            block = fp.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def recommended_chunk_size(size, throughput=None):
+    """
+    Returns the chunk size a file of size bytes should be sent with. Large
+    files are sent in larger chunks, so they need fewer requests, but no
+    chunk should take longer than CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS at
+    the throughput measured for the submission, if known.
+    """
+    chunk_size = size // CHUNKS_PER_FILE
+    if throughput:
+        chunk_size = min(chunk_size,
+                         int(throughput * CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS))
+    chunk_size = max(CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE,
+                     min(chunk_size, CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE))
+    # whole copy buffers
+    return max(COPY_BUFFER_SIZE, chunk_size - chunk_size % COPY_BUFFER_SIZE)
+
+
+def chunk_size(request, sub_id):
+    """
+    Tells the client which chunk size to send file request.args['size']
+    with, based on its size and the throughput of the submission so far.
+    """
+    try:
+        size = int(request.args.get('size'))
+    except (TypeError, ValueError):
+        return "Invalid size", 400
+    throughput = manifest.read_manifest(get_upload_dir(sub_id)).get(
+        'throughput')
+    return jsonify(chunk_size=recommended_chunk_size(size, throughput))
+
+
+def upload_status(request, sub_id):
+    """
+    Reports which chunks of file request.args['name'] have been received,
+    so an interrupted upload can be resumed with the missing chunks only.
+    """
+    name = request.args.get('name', '')
+    filename = secure_filename(name)
+    upload_dir = get_upload_dir(sub_id)
+    entry = manifest.read_manifest(upload_dir)['files'].get(filename)
+    if entry is None:
+        return jsonify(name=name, received=[], missing=None,
+                       resume_offset=0, complete=False)
+
+    return jsonify(name=name,
+                   chunks=entry['chunks'],
+                   chunk_size=entry.get('chunk_size'),
+                   size=entry.get('size'),
+                   received=entry['received'],
+                   missing=manifest.missing_chunks(entry),
+                   bytes_received=entry['bytes_received'],
+                   resume_offset=manifest.resume_offset(entry),
+                   complete=entry['complete'])
+
+
+def check_status(request, sub_id):
+    """
+    Reports the progress of every file of the submission, the state of
+    the submission and the stage its finalization job has reached, from
+    the manifest alone.
+
+    With request.values['since'] set to the version of a previous answer,
+    the request waits, up to request.values['wait'] seconds, for the
+    submission to change, so that clients can long-poll instead of asking
+    over and over again.
+    """
+    upload_dir = get_upload_dir(sub_id)
+    path = os.path.join(upload_dir, manifest.MANIFEST_FILENAME)
+    since = request.values.get('since', type=float)
+    if since is not None:
+        wait = min(request.values.get('wait', CFG_SIMPLESTORE_STATUS_MAX_WAIT,
+                                      type=float),
+                   CFG_SIMPLESTORE_STATUS_MAX_WAIT)
+        deadline = time.time() + wait
+        while _manifest_version(path) == since and time.time() < deadline:
+            time.sleep(STATUS_POLL_INTERVAL)
+
+    version = _manifest_version(path)
+    stored = manifest.read_manifest(upload_dir)
+    files = []
+    for filename, entry in sorted(stored['files'].items()):
+        received = sum(end - start for start, end in entry['received'])
+        files.append(dict(filename=filename,
+                          name=entry['name'],
+                          size=entry.get('size'),
+                          bytes_received=entry['bytes_received'],
+                          chunks=entry['chunks'],
+                          chunks_received=received,
+                          complete=entry['complete'],
+                          assembling=entry.get('assembling', False)))
+    return jsonify(sub_id=sub_id,
+                   version=version,
+                   state=stored.get('state'),
+                   job=stored.get('job'),
+                   files=files,
+                   bytes_received=sum(f['bytes_received'] for f in files),
+                   complete=bool(files) and all(f['complete'] for f in files))
+
+
+def check_status_noarg(request):
+    """ check_status() for the submission given in the request values """
+    sub_id = request.values.get('sub_id')
+    if not sub_id:
+        return "Submission id missing", 400
+    return check_status(request, sub_id)
+
+
+def _manifest_version(path):
+    """
+    Returns the version of the manifest at path, which changes whenever
+    the manifest is written, or 0 if there is no manifest yet.
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+
+def list_uploaded_files(upload_dir):
+    """
+    Returns the names of the uploaded files in upload_dir, leaving out the
+    manifest, file metadata and files that are still being assembled.
+    """
+    return [f for f in os.listdir(upload_dir)
+            if not (f.startswith('.') or f.startswith('metadata_') or
+                    f.endswith(PARTIAL_SUFFIX))]
+
+
 def delete(request, sub_id):
     """
     Deletes file with name form['filename'] if it exists in upload_dir.
@@ -120,9 +1107,15 @@ def delete(request, sub_id):
 
     result = ""
 
-    upload_dir = os.path.join(CFG_SIMPLESTORE_UPLOAD_FOLDER, sub_id)
+    upload_dir = get_upload_dir(sub_id)
     filename = request.form['filename']
 
+    # upload() answers with the secure name of the file, which is the key
+    # of the manifest entry pointing to the stored file
+    entry = manifest.remove_file(upload_dir, filename)
+    if entry is not None and entry.get('file'):
+        filename = os.path.basename(entry['file'])
+
     files = os.listdir(upload_dir)
     # delete all for minute
     for f in files:
@@ -142,17 +1135,102 @@ def get_file(request, sub_id):
 
     I don't really think we need this, but it's easier to implement than to
     remove the functionality.
+
+    Supports byte ranges and conditional requests, and can hand the
+    transfer over to the web server (see CFG_SIMPLESTORE_DOWNLOAD_ACCEL).
     """
-    filename = request.args.get('filename')
-    # make sure that request doesn't go outside the CFG_SIMPLESTORE_UPLOAD_FOLDER
-    if not os.path.samefile(
-                            CFG_SIMPLESTORE_UPLOAD_FOLDER,
-                            os.path.commonprefix([CFG_SIMPLESTORE_UPLOAD_FOLDER,
-                              os.path.realpath(filename)])):
+    filename = request.args.get('filename', '')
+    upload_dir = get_upload_dir(sub_id)
+    # the page links the secure name of the file, which is the key of the
+    # manifest entry pointing to the stored file, as for delete()
+    entry = manifest.read_manifest(upload_dir)['files'].get(filename)
+    if entry is not None and entry.get('complete') and entry.get('file'):
+        stored = os.path.basename(entry['file'])
+    else:
+        stored = filename
+    f = os.path.join(upload_dir, stored)
+    # make sure that request doesn't go outside the submission directory,
+    # and doesn't fetch the manifest or a file being assembled
+    if (stored.startswith('.') or stored.endswith(PARTIAL_SUFFIX) or
+            os.path.dirname(os.path.realpath(f)) !=
+            os.path.realpath(upload_dir) or not os.path.isfile(f)):
         return "File " + filename + " not found", 404
 
-    f = os.path.join(CFG_SIMPLESTORE_UPLOAD_FOLDER, sub_id, filename)
-    if (os.path.isfile(f)):
-        return send_file(f, attachment_filename=filename, as_attachment=True)
+    st = os.stat(f)
+    # uploads are never modified in place, so this identifies the content
+    etag = '%x-%x-%x' % (st.st_ino, st.st_size, int(st.st_mtime))
+    last_modified = int(st.st_mtime)
+    headers = {'Accept-Ranges': 'bytes',
+               'Content-Disposition': 'attachment; filename=%s' % filename}
+
+    if CFG_SIMPLESTORE_DOWNLOAD_ACCEL == 'X-Accel-Redirect':
+        headers['X-Accel-Redirect'] = CFG_SIMPLESTORE_DOWNLOAD_ACCEL_PREFIX + \
+            os.path.relpath(f, CFG_SIMPLESTORE_UPLOAD_FOLDER)
+        rv = current_app.response_class(
+            headers=headers, mimetype='application/octet-stream')
+    elif CFG_SIMPLESTORE_DOWNLOAD_ACCEL:
+        headers['X-Sendfile'] = f
+        rv = current_app.response_class(
+            headers=headers, mimetype='application/octet-stream')
     else:
-        return "File " + filename + " not found", 404
+        rv = _file_response(request, f, st.st_size, headers,
+                            _if_range_matches(request, etag, last_modified))
+
+    rv.set_etag(etag)
+    rv.last_modified = last_modified
+    rv.cache_control.private = True
+    return rv.make_conditional(request)
+
+
+def _if_range_matches(request, etag, last_modified):
+    """
+    Returns True unless the request has an If-Range header naming another
+    version of the file, in which case the whole file has to be sent.
+    """
+    if_range = parse_if_range_header(request.headers.get('If-Range'))
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return timegm(if_range.date.utctimetuple()) == last_modified
+    return True
+
+
+def _file_response(request, path, size, headers, use_range=True):
+    """
+    Returns a response streaming the file at path, or the byte range of it
+    asked for in the Range header of the request.
+    """
+    byte_range = parse_range_header(request.headers.get('Range'))
+    if byte_range is not None and use_range:
+        byte_range = byte_range.range_for_length(size)
+        if byte_range is None:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return current_app.response_class(status=416, headers=headers)
+        start, stop = byte_range
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        headers['Content-Length'] = str(stop - start)
+        return current_app.response_class(_read_range(path, start, stop),
+                                          status=206, headers=headers,
+                                          mimetype='application/octet-stream',
+                                          direct_passthrough=True)
+
+    headers['Content-Length'] = str(size)
+    return current_app.response_class(wrap_file(request.environ,
+                                                open(path, 'rb'),
+                                                COPY_BUFFER_SIZE),
+                                      headers=headers,
+                                      mimetype='application/octet-stream',
+                                      direct_passthrough=True)
+
+
+def _read_range(path, start, stop):
+    """ Yields the bytes of the file at path from start to stop """
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = fp.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
@@ -0,0 +1,85 @@
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_archive as archive
+from StringIO import StringIO
+import tarfile
+import zipfile
+
+
+def make_zip(files):
+    """ Returns a zip archive of the files, a list of (path, data) """
+    buf = StringIO()
+    z = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    for path, data in files:
+        z.writestr(path, data)
+    z.close()
+    buf.seek(0)
+    return buf
+
+
+def make_tar(files):
+    """ Returns a gzipped tar archive of the files, a list of (path, data) """
+    buf = StringIO()
+    t = tarfile.open(fileobj=buf, mode='w:gz')
+    for path, data in files:
+        info = tarfile.TarInfo(path)
+        info.size = len(data)
+        t.addfile(info, StringIO(data))
+    t.close()
+    buf.seek(0)
+    return buf
+
+
+def extract(fileobj, name):
+    """ Returns the (path, data) of every member of the archive """
+    # members are read in blocks, as uploads are
+    return [(path, ''.join(iter(lambda: member.read(4096), '')))
+            for path, member in archive.iter_members(fileobj, name)]
+
+
+class ArchiveLimitsTest(InvenioTestCase):
+
+    def setUp(self):
+        self.saved = (archive.CFG_SIMPLESTORE_EXTRACT_MAX_SIZE,
+                      archive.CFG_SIMPLESTORE_EXTRACT_MAX_FILES)
+        archive.CFG_SIMPLESTORE_EXTRACT_MAX_SIZE = 1000
+        archive.CFG_SIMPLESTORE_EXTRACT_MAX_FILES = 3
+
+    def tearDown(self):
+        (archive.CFG_SIMPLESTORE_EXTRACT_MAX_SIZE,
+         archive.CFG_SIMPLESTORE_EXTRACT_MAX_FILES) = self.saved
+
+    def test_within_limits(self):
+        """Archives within the limits are extracted whole"""
+        files = [('a.txt', 'a' * 500), ('dir/b.txt', 'b' * 500)]
+        self.assertEqual(extract(make_zip(files), 'x.zip'), files)
+        self.assertEqual(extract(make_tar(files), 'x.tar.gz'), files)
+
+    def test_too_large(self):
+        """The size of all files together is limited"""
+        files = [('a.txt', 'a' * 600), ('b.txt', 'b' * 600)]
+        self.assertRaises(archive.ArchiveError, extract,
+                          make_zip(files), 'x.zip')
+        # a single member cannot exceed the limit either, e.g. a zip bomb
+        self.assertRaises(archive.ArchiveError, extract,
+                          make_tar([('a.txt', '\0' * 100000)]), 'x.tgz')
+
+    def test_too_many_files(self):
+        """The number of files is limited"""
+        files = [('%d.txt' % i, '') for i in range(4)]
+        self.assertRaises(archive.ArchiveError, extract,
+                          make_zip(files), 'x.zip')
+        self.assertRaises(archive.ArchiveError, extract,
+                          make_tar(files), 'x.tar.gz')
+
+    def test_broken(self):
+        """Broken archives raise ArchiveError"""
+        self.assertRaises(archive.ArchiveError, extract,
+                          StringIO('garbage' * 100), 'x.zip')
+        self.assertRaises(archive.ArchiveError, extract,
+                          StringIO('garbage' * 100), 'x.tar')
+
+
+TEST_SUITE = make_test_suite(ArchiveLimitsTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
@@ -0,0 +1,85 @@
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_janitor as janitor
+import invenio.simplestore_manifest as manifest
+import invenio.simplestore_upload_handler as uph
+from invenio.jsonutils import json
+import os
+import shutil
+import tempfile
+import time
+
+HOUR = 3600
+
+
+class StaleSubmissionTest(InvenioTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (janitor.iter_upload_dirs,
+                      janitor.quota.CFG_SIMPLESTORE_QUOTA_FOLDER,
+                      janitor.spool.CFG_SIMPLESTORE_SPOOL_FOLDER)
+        janitor.iter_upload_dirs = lambda: uph.iter_upload_dirs(self.folder)
+
+    def tearDown(self):
+        (janitor.iter_upload_dirs,
+         janitor.quota.CFG_SIMPLESTORE_QUOTA_FOLDER,
+         janitor.spool.CFG_SIMPLESTORE_SPOOL_FOLDER) = self.saved
+        shutil.rmtree(self.folder)
+
+    def submission(self, sub_id, state=None, age=0):
+        """ Creates a submission last changed age seconds ago """
+        upload_dir = os.path.join(self.folder, sub_id)
+        os.mkdir(upload_dir)
+        stored = manifest.new_manifest()
+        stored['updated'] -= age
+        if state is not None:
+            stored['state'] = state
+        with open(os.path.join(upload_dir, manifest.MANIFEST_FILENAME),
+                  'wb') as fp:
+            json.dump(stored, fp)
+        return upload_dir
+
+    def test_is_stale(self):
+        """Submitted and unsubmitted submissions are kept for their own age"""
+        now = time.time()
+        unsubmitted = self.submission('4fa21e3c-1111-11e3-8000-000000000001')
+        submitted = self.submission('4fa21e3c-1111-11e3-8000-000000000002',
+                                    state='submitted')
+        self.assertFalse(janitor.is_stale(unsubmitted, now + 47 * HOUR,
+                                          48 * HOUR, 168 * HOUR))
+        self.assertTrue(janitor.is_stale(unsubmitted, now + 49 * HOUR,
+                                         48 * HOUR, 168 * HOUR))
+        self.assertFalse(janitor.is_stale(submitted, now + 49 * HOUR,
+                                          48 * HOUR, 168 * HOUR))
+        self.assertTrue(janitor.is_stale(submitted, now + 169 * HOUR,
+                                         48 * HOUR, 168 * HOUR))
+
+    def test_without_manifest(self):
+        """Submissions without a manifest are dated by their directory"""
+        upload_dir = os.path.join(self.folder,
+                                  '4fa21e3c-1111-11e3-8000-000000000003')
+        os.mkdir(upload_dir)
+        old = time.time() - 49 * HOUR
+        os.utime(upload_dir, (old, old))
+        self.assertTrue(janitor.is_stale(upload_dir, time.time(),
+                                         48 * HOUR, 168 * HOUR))
+
+    def test_reserved_folders(self):
+        """Folders of SimpleStore kept in the upload folder are left alone"""
+        stale = self.submission('4fa21e3c-1111-11e3-8000-000000000004',
+                                age=49 * HOUR)
+        self.submission('4fa21e3c-1111-11e3-8000-000000000005')
+        # named like submissions, and as old as the stale one
+        janitor.quota.CFG_SIMPLESTORE_QUOTA_FOLDER = self.submission(
+            '4fa21e3c-1111-11e3-8000-000000000006', age=49 * HOUR)
+        janitor.spool.CFG_SIMPLESTORE_SPOOL_FOLDER = self.submission(
+            '4fa21e3c-1111-11e3-8000-000000000007', age=49 * HOUR)
+        os.mkdir(os.path.join(self.folder, 'not-a-submission'))
+        self.assertEqual(list(janitor.find_stale_submissions(48 * HOUR,
+                                                             168 * HOUR)),
+                         [stale])
+
+TEST_SUITE = make_test_suite(StaleSubmissionTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
@@ -0,0 +1,161 @@
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_manifest as manifest
+import os
+import shutil
+import tempfile
+import threading
+
+
+class AddChunkTest(InvenioTestCase):
+
+    def test_merges_adjacent_chunks(self):
+        """Chunks received in any order are merged into ranges"""
+        entry = dict(received=[])
+        for chunk in [3, 0, 5, 1, 4]:
+            self.assertTrue(manifest.add_chunk(entry, chunk))
+        self.assertEqual(entry['received'], [[0, 2], [3, 6]])
+        self.assertTrue(manifest.add_chunk(entry, 2))
+        self.assertEqual(entry['received'], [[0, 6]])
+
+    def test_duplicate_chunk(self):
+        """A chunk received twice is only recorded once"""
+        entry = dict(received=[[0, 3]])
+        self.assertFalse(manifest.add_chunk(entry, 1))
+        self.assertEqual(entry['received'], [[0, 3]])
+
+
+class RecordChunkTest(InvenioTestCase):
+
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.upload_dir)
+
+    def record(self, chunk, chunks, size, chunk_size, total_size,
+               filename='data.csv'):
+        return manifest.record_chunk(self.upload_dir, filename, filename,
+                                     chunk, chunks, size, chunk_size,
+                                     total_size)
+
+    def test_single_finalizer(self):
+        """Exactly one of the concurrent last chunks assembles the file"""
+        chunks = 40
+        lasts = []
+
+        def send(chunk):
+            entry, last = self.record(chunk, chunks, 10, 10, chunks * 10)
+            lasts.append(last)
+
+        threads = [threading.Thread(target=send, args=(chunk, ))
+                   for chunk in range(chunks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(lasts.count(True), 1)
+        entry = manifest.read_manifest(self.upload_dir)['files']['data.csv']
+        self.assertEqual(entry['received'], [[0, chunks]])
+        self.assertEqual(entry['bytes_received'], chunks * 10)
+        self.assertTrue(entry['assembling'])
+        # a chunk sent again does not start a second assembly
+        self.assertFalse(self.record(0, chunks, 10, 10, chunks * 10)[1])
+
+    def test_wrong_chunk_size(self):
+        """A chunk of the wrong size is reported as missing"""
+        self.record(0, 3, 9, 10, 25)
+        entry, last = self.record(1, 3, 10, 10, 25)
+        self.assertEqual(entry['received'], [[1, 2]])
+        self.assertEqual(manifest.missing_chunks(entry), [0, 2])
+
+    def test_upload_with_other_parameters(self):
+        """A file sent again with other chunks restarts its entry"""
+        self.record(0, 3, 10, 10, 25)
+        self.record(1, 3, 10, 10, 25)
+        entry, last = self.record(1, 2, 7, 8, 15)
+        self.assertFalse(last)
+        self.assertEqual((entry['chunks'], entry['size']), (2, 15))
+        self.assertEqual(entry['received'], [[1, 2]])
+        self.assertEqual(entry['bytes_received'], 7)
+        entry, last = self.record(0, 2, 8, 8, 15)
+        self.assertTrue(last)
+
+    def test_complete_file(self):
+        """A chunk of a complete file only restarts it if sent otherwise"""
+        self.record(0, 1, 5, 5, 5)
+        manifest.record_file(self.upload_dir, 'data.csv', 'data.csv',
+                             '/nonexistent', 5, 'a' * 64)
+        entry, last = self.record(0, 1, 5, 5, 5)
+        self.assertFalse(last)
+        self.assertTrue(entry['complete'])
+        self.assertEqual(entry['sha256'], 'a' * 64)
+        entry, last = self.record(0, 1, 6, 6, 6)
+        self.assertTrue(last)
+        self.assertNotIn('file', entry)
+
+    def test_assembly_failed(self):
+        """A file whose assembly failed is assembled by the next chunk"""
+        self.record(0, 1, 5, 5, 5)
+        manifest.assembly_failed(self.upload_dir, 'data.csv')
+        self.assertTrue(self.record(0, 1, 5, 5, 5)[1])
+        manifest.assembly_failed(self.upload_dir, 'data.csv',
+                                 chunks_lost=True)
+        entry = manifest.read_manifest(self.upload_dir)['files']['data.csv']
+        self.assertEqual(entry['received'], [])
+        self.assertNotIn('assembling', entry)
+
+
+class ReadManifestTest(InvenioTestCase):
+
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.upload_dir)
+
+    def test_undecodable(self):
+        """A manifest that cannot be decoded is taken for an empty one"""
+        with open(os.path.join(self.upload_dir, manifest.MANIFEST_FILENAME),
+                  'wb') as fp:
+            fp.write('{"files": {"data.csv"')
+        self.assertEqual(manifest.read_manifest(self.upload_dir)['files'], {})
+        manifest.record_file(self.upload_dir, 'a.txt', 'a.txt', '/a', 1,
+                             'a' * 64)
+        self.assertEqual(
+            list(manifest.read_manifest(self.upload_dir)['files']), ['a.txt'])
+
+
+class RecordFilesTest(InvenioTestCase):
+
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.upload_dir)
+
+    def test_record_files(self):
+        """Files recorded at once are as if recorded one by one"""
+        manifest.record_files(self.upload_dir,
+                              [('a.txt', 'a.txt', '/a', 1, 'a' * 64, None),
+                               ('b.txt', 'b.txt', '/b', 2, 'b' * 64, None)])
+        together = manifest.read_manifest(self.upload_dir)
+        other_dir = tempfile.mkdtemp()
+        try:
+            manifest.record_file(other_dir, 'a.txt', 'a.txt', '/a', 1,
+                                 'a' * 64)
+            manifest.record_file(other_dir, 'b.txt', 'b.txt', '/b', 2,
+                                 'b' * 64)
+            apart = manifest.read_manifest(other_dir)
+        finally:
+            shutil.rmtree(other_dir)
+        self.assertEqual(sorted(together['files']), ['a.txt', 'b.txt'])
+        self.assertEqual(together['sha256'], apart['sha256'])
+        self.assertEqual(together['sha256'],
+                         manifest.submission_checksum(['a' * 64, 'b' * 64]))
+
+
+TEST_SUITE = make_test_suite(AddChunkTest, RecordChunkTest, ReadManifestTest,
+                             RecordFilesTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
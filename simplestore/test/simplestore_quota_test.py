@@ -0,0 +1,88 @@
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_quota as quota
+import shutil
+import tempfile
+
+
+class QuotaTest(InvenioTestCase):
+
+    def setUp(self):
+        self.saved = (quota.CFG_SIMPLESTORE_QUOTA_FOLDER,
+                      quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER,
+                      quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT,
+                      quota.CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT_PER_USER,
+                      quota.CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT)
+        quota.CFG_SIMPLESTORE_QUOTA_FOLDER = tempfile.mkdtemp()
+        quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER = 2
+        quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT = 3
+        quota.CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT_PER_USER = 100
+        quota.CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT = 1000
+        self.held = []
+
+    def tearDown(self):
+        for slots in self.held:
+            quota.release(slots)
+        shutil.rmtree(quota.CFG_SIMPLESTORE_QUOTA_FOLDER)
+        (quota.CFG_SIMPLESTORE_QUOTA_FOLDER,
+         quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER,
+         quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT,
+         quota.CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT_PER_USER,
+         quota.CFG_SIMPLESTORE_UPLOAD_MAX_INFLIGHT) = self.saved
+
+    def acquire(self, user_id, size=1):
+        slots = quota.acquire(user_id, size)
+        self.held.append(slots)
+        return slots
+
+    def release(self, slots):
+        self.held.remove(slots)
+        quota.release(slots)
+
+    def test_concurrent_per_user(self):
+        """A user only has so many uploads in progress"""
+        first = self.acquire(1)
+        self.acquire(1)
+        try:
+            self.acquire(1)
+            self.fail("a third upload was let through")
+        except quota.QuotaExceeded as e:
+            self.assertEqual(e.retry_after,
+                             quota.CFG_SIMPLESTORE_UPLOAD_RETRY_AFTER)
+        self.release(first)
+        self.acquire(1)
+
+    def test_concurrent(self):
+        """The site only has so many uploads in progress"""
+        for user_id in [1, 2, 3]:
+            self.acquire(user_id)
+        held = len(quota._held)
+        self.assertRaises(quota.QuotaExceeded, self.acquire, 4)
+        # the slot of the user is given back when the site is busy
+        self.assertEqual(len(quota._held), held)
+
+    def test_bytes_in_flight(self):
+        """A user only has so many bytes in flight"""
+        self.acquire(1, 60)
+        self.assertRaises(quota.QuotaExceeded, self.acquire, 1, 50)
+        self.acquire(1, 40)
+        # the bytes of other users do not count
+        self.acquire(2, 50)
+
+    def test_large_request(self):
+        """A request larger than the limit is let through on its own"""
+        slots = self.acquire(1, 500)
+        self.assertRaises(quota.QuotaExceeded, self.acquire, 1, 1)
+        self.release(slots)
+        self.acquire(1, 1)
+
+    def test_disabled(self):
+        """A limit of 0 takes no slots"""
+        quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT_PER_USER = 0
+        quota.CFG_SIMPLESTORE_UPLOAD_MAX_CONCURRENT = 0
+        self.assertEqual(self.acquire(1), [])
+
+
+TEST_SUITE = make_test_suite(QuotaTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
@@ -0,0 +1,100 @@
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_recid as recid
+import os
+import tempfile
+import threading
+
+
+class FakeBibrec(object):
+    """ Stands in for run_sql, with an auto-increment bibrec table """
+
+    def __init__(self, next_id=1000, lock_mode=1):
+        self.next_id = next_id
+        self.lock_mode = lock_mode
+        self.inserts = 0
+        self.dated = []
+        self.lock = threading.Lock()
+
+    def __call__(self, query, params=None):
+        with self.lock:
+            if query.startswith('SELECT @@innodb_autoinc_lock_mode'):
+                return ((self.lock_mode, ), )
+            if query.startswith('SELECT max(id)+1'):
+                return ((self.next_id, ), )
+            if query.startswith('UPDATE bibrec'):
+                self.dated.append(params[0])
+                return 1
+            first = self.next_id
+            self.next_id += query.count('(NOW(), NOW())')
+            self.inserts += 1
+            return first
+
+
+class RecidAllocatorTest(InvenioTestCase):
+
+    def setUp(self):
+        self.saved = (recid.run_sql, recid.CFG_SIMPLESTORE_RECID_BLOCK_SIZE,
+                      recid.CFG_SIMPLESTORE_RECID_FILE, recid._consecutive)
+        fd, recid.CFG_SIMPLESTORE_RECID_FILE = tempfile.mkstemp()
+        os.close(fd)
+        recid.CFG_SIMPLESTORE_RECID_BLOCK_SIZE = 10
+        recid._consecutive = None
+        recid.run_sql = self.bibrec = FakeBibrec()
+
+    def tearDown(self):
+        os.remove(recid.CFG_SIMPLESTORE_RECID_FILE)
+        (recid.run_sql, recid.CFG_SIMPLESTORE_RECID_BLOCK_SIZE,
+         recid.CFG_SIMPLESTORE_RECID_FILE, recid._consecutive) = self.saved
+
+    def test_blocks(self):
+        """Ids are taken from blocks, each reserved with one insert"""
+        ids = [recid.new_recid() for i in range(25)]
+        self.assertEqual(ids, range(1000, 1025))
+        self.assertEqual(self.bibrec.inserts, 3)
+
+    def test_concurrent(self):
+        """Concurrent callers never get the same id"""
+        ids = []
+
+        def take():
+            for i in range(20):
+                ids.append(recid.new_recid())
+
+        threads = [threading.Thread(target=take) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(ids), range(1000, 1100))
+
+    def test_dated_when_taken(self):
+        """Reserved rows are dated when their id is handed out"""
+        ids = [recid.new_recid() for i in range(3)]
+        # the first row was dated when the block was inserted
+        self.assertEqual(self.bibrec.dated, ids[1:])
+
+    def test_peek(self):
+        """peek_recid tells the next id without taking it"""
+        self.assertEqual(recid.peek_recid(), 1000)
+        self.assertEqual(recid.new_recid(), 1000)
+        self.assertEqual(recid.peek_recid(), 1001)
+        self.assertEqual(recid.new_recid(), 1001)
+
+    def test_damaged_file(self):
+        """A damaged file only leaves the rest of its block unused"""
+        recid.new_recid()
+        open(recid.CFG_SIMPLESTORE_RECID_FILE, 'w').write('garbage')
+        self.assertEqual(recid.new_recid(), 1010)
+
+    def test_interleaved(self):
+        """Without consecutive multi-row inserts, ids are taken one by one"""
+        self.bibrec.lock_mode = 2
+        self.assertEqual([recid.new_recid() for i in range(3)],
+                         [1000, 1001, 1002])
+        self.assertEqual(self.bibrec.inserts, 3)
+
+
+TEST_SUITE = make_test_suite(RecidAllocatorTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
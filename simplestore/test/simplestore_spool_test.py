@@ -0,0 +1,105 @@
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_spool as spool
+import invenio.simplestore_manifest as manifest
+import os
+import shutil
+import tempfile
+import time
+
+
+class SpoolTest(InvenioTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (spool.CFG_SIMPLESTORE_SPOOL_FOLDER,
+                      spool.CFG_SIMPLESTORE_SPOOL_MAX_RECORDS,
+                      spool.CFG_SIMPLESTORE_SPOOL_MAX_DELAY,
+                      spool.get_upload_dir, spool.submit,
+                      spool._schedule_flush)
+        spool.CFG_SIMPLESTORE_SPOOL_FOLDER = os.path.join(self.folder,
+                                                          'spool')
+        spool.CFG_SIMPLESTORE_SPOOL_MAX_RECORDS = 3
+        spool.CFG_SIMPLESTORE_SPOOL_MAX_DELAY = 30
+        spool.get_upload_dir = lambda sub_id: os.path.join(self.folder,
+                                                           sub_id)
+        self.submitted = []
+        spool.submit = self.submit
+        self.scheduled = []
+        spool._schedule_flush = self.scheduled.append
+
+    def tearDown(self):
+        (spool.CFG_SIMPLESTORE_SPOOL_FOLDER,
+         spool.CFG_SIMPLESTORE_SPOOL_MAX_RECORDS,
+         spool.CFG_SIMPLESTORE_SPOOL_MAX_DELAY,
+         spool.get_upload_dir, spool.submit,
+         spool._schedule_flush) = self.saved
+        shutil.rmtree(self.folder)
+
+    def submit(self, records):
+        """ Stands in for spool.submit, numbering the tasks """
+        self.submitted.append(records)
+        return len(self.submitted)
+
+    def add(self, sub_id):
+        upload_dir = os.path.join(self.folder, sub_id)
+        os.mkdir(upload_dir)
+        manifest.start_job(upload_dir, sub_id, 3600)
+        manifest.update_job(upload_dir, 'spooled')
+        return spool.add(sub_id, u'<record>%s</record>' % sub_id)
+
+    def job(self, sub_id):
+        return manifest.read_manifest(os.path.join(self.folder,
+                                                   sub_id))['job']
+
+    def test_full(self):
+        """The records are submitted together once the spool is full"""
+        self.assertEqual(self.add('a'), None)
+        self.assertEqual(self.add('b'), None)
+        self.assertEqual(spool.spooled_records()[0], ['a', 'b'])
+        self.assertEqual(self.scheduled, [30, 30])
+        self.assertEqual(self.add('c'), 1)
+        self.assertEqual(len(self.submitted), 1)
+        self.assertEqual(sorted(self.submitted[0]),
+                         [u'<record>a</record>', u'<record>b</record>',
+                          u'<record>c</record>'])
+        self.assertEqual(spool.spooled_records(), ([], None))
+        for sub_id in 'abc':
+            job = self.job(sub_id)
+            self.assertEqual((job['stage'], job['task_id']), ('done', 1))
+
+    def test_due(self):
+        """A record is submitted once it has waited long enough"""
+        self.add('a')
+        self.assertEqual(spool.flush(), None)
+        old = time.time() - 31
+        os.utime(spool._record_path('a'), (old, old))
+        self.assertEqual(spool.flush(), 1)
+        self.assertEqual(self.job('a')['stage'], 'done')
+
+    def test_force(self):
+        """A forced flush submits whatever is spooled"""
+        self.assertEqual(spool.flush(force=True), None)
+        self.add('a')
+        self.assertEqual(spool.flush(force=True), 1)
+        self.assertEqual(self.submitted, [[u'<record>a</record>']])
+
+    def test_failed_flush(self):
+        """A record stays spooled when it cannot be submitted"""
+        spool.CFG_SIMPLESTORE_SPOOL_MAX_RECORDS = 1
+
+        def fail(records):
+            raise OSError("bibsched is down")
+        spool.submit = fail
+        self.assertEqual(self.add('a'), None)
+        self.assertEqual(spool.spooled_records()[0], ['a'])
+        self.assertEqual(self.job('a')['stage'], 'spooled')
+        self.assertEqual(self.scheduled, [30])
+        spool.submit = self.submit
+        self.assertEqual(spool.flush(), 1)
+        self.assertEqual(self.job('a')['stage'], 'done')
+
+
+TEST_SUITE = make_test_suite(SpoolTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_typeahead as typeahead
+
+
+class TypeaheadIndexTest(InvenioTestCase):
+
+    def setUp(self):
+        self.index = typeahead.build_index(
+            ['English', 'Old English', 'Scottish Gaelic', 'Irish Gaelic',
+             'N&apos;Ko', 'Volapük'])
+
+    def test_prefix(self):
+        """Values are found by the beginning of any of their words"""
+        self.assertEqual(typeahead.search(self.index, 'eng'),
+                         [u'English', u'Old English'])
+        self.assertEqual(typeahead.search(self.index, 'GAEL'),
+                         [u'Scottish Gaelic', u'Irish Gaelic'])
+        self.assertEqual(typeahead.search(self.index, 'old  eng'),
+                         [u'Old English'])
+
+    def test_no_match(self):
+        """Nothing is found for an empty or unknown query"""
+        self.assertEqual(typeahead.search(self.index, ''), [])
+        self.assertEqual(typeahead.search(self.index, '   '), [])
+        self.assertEqual(typeahead.search(self.index, 'xyz'), [])
+
+    def test_limit(self):
+        """At most limit values are returned"""
+        self.assertEqual(len(typeahead.search(self.index, 'g', 1)), 1)
+
+    def test_decoding(self):
+        """Values are unicode, without HTML entities"""
+        self.assertEqual(typeahead.search(self.index, "n'"), [u"N'Ko"])
+        self.assertEqual(typeahead.search(self.index, u'volapü'),
+                         [u'Volap\xfck'])
+
+    def test_unknown_source(self):
+        """There is no index for an unknown source"""
+        self.assertEqual(typeahead.get_index('no_such_source'), None)
+
+
+TEST_SUITE = make_test_suite(TypeaheadIndexTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
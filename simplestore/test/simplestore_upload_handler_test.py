@@ -0,0 +1,297 @@
+from invenio.testutils import make_test_suite, run_test_suite, InvenioTestCase
+import invenio.simplestore_upload_handler as uph
+import invenio.simplestore_manifest as manifest
+import invenio.simplestore_blobstore as blobstore
+from invenio.jsonutils import json
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from StringIO import StringIO
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+MB = 1024 * 1024
+
+
+class RecommendedChunkSizeTest(InvenioTestCase):
+
+    def setUp(self):
+        self.saved = (uph.CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE,
+                      uph.CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE,
+                      uph.CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS)
+        uph.CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE = 1 * MB
+        uph.CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE = 32 * MB
+        uph.CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS = 5
+
+    def tearDown(self):
+        (uph.CFG_SIMPLESTORE_UPLOAD_CHUNK_SIZE,
+         uph.CFG_SIMPLESTORE_UPLOAD_MAX_CHUNK_SIZE,
+         uph.CFG_SIMPLESTORE_UPLOAD_CHUNK_SECONDS) = self.saved
+
+    def test_bounds(self):
+        """Chunks are neither smaller nor larger than configured"""
+        self.assertEqual(uph.recommended_chunk_size(10), 1 * MB)
+        self.assertEqual(uph.recommended_chunk_size(100 * 1024 * MB), 32 * MB)
+        self.assertEqual(uph.recommended_chunk_size(640 * MB), 10 * MB)
+
+    def test_throughput(self):
+        """No chunk takes longer than the configured time to send"""
+        self.assertEqual(uph.recommended_chunk_size(640 * MB, 1 * MB), 5 * MB)
+        self.assertEqual(uph.recommended_chunk_size(640 * MB, 1024), 1 * MB)
+
+    def test_whole_buffers(self):
+        """Chunks are made of whole copy buffers"""
+        size = uph.recommended_chunk_size(1000 * MB + 12345)
+        self.assertEqual(size % uph.COPY_BUFFER_SIZE, 0)
+
+
+class InplaceUploadTest(InvenioTestCase):
+
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+        self.blob_folder = blobstore.CFG_SIMPLESTORE_BLOB_FOLDER
+        blobstore.CFG_SIMPLESTORE_BLOB_FOLDER = None
+
+    def tearDown(self):
+        blobstore.CFG_SIMPLESTORE_BLOB_FOLDER = self.blob_folder
+        shutil.rmtree(self.upload_dir)
+
+    def send(self, data, chunk_size, chunks, name='data.csv'):
+        total = (len(data) + chunk_size - 1) // chunk_size
+        for chunk in chunks:
+            rv = uph._store_chunk_inplace(
+                self.upload_dir, name, chunk, total, chunk_size, len(data),
+                StringIO(data[chunk * chunk_size:(chunk + 1) * chunk_size]))
+        return rv
+
+    def entry(self, filename='data.csv'):
+        return manifest.read_manifest(self.upload_dir)['files'][filename]
+
+    def test_out_of_order(self):
+        """Chunks sent in any order make up the file"""
+        data = ''.join(chr(i % 256) for i in range(1000))
+        self.send(data, 64, reversed(range(16)))
+        entry = self.entry()
+        self.assertTrue(entry['complete'])
+        self.assertEqual(open(entry['file'], 'rb').read(), data)
+        self.assertEqual(entry['sha256'], hashlib.sha256(data).hexdigest())
+
+    def test_sent_again_smaller(self):
+        """A file sent again with another size replaces the partial one"""
+        self.send('A' * 25, 9, [0, 1])
+        data = 'b' * 15
+        self.send(data, 8, [1, 0])
+        entry = self.entry()
+        self.assertTrue(entry['complete'])
+        self.assertEqual(entry['size'], 15)
+        self.assertEqual(open(entry['file'], 'rb').read(), data)
+        self.assertEqual(entry['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(uph.list_uploaded_files(self.upload_dir),
+                         [os.path.basename(entry['file'])])
+
+    def test_sent_again_when_complete(self):
+        """A chunk sent again once the file is complete is only acknowledged"""
+        data = 'c' * 15
+        self.send(data, 8, [0, 1])
+        before = self.entry()
+        self.assertEqual(self.send(data, 8, [1]), 'data.csv')
+        self.assertEqual(self.entry(), before)
+        self.assertEqual(open(before['file'], 'rb').read(), data)
+        self.assertEqual(uph.list_uploaded_files(self.upload_dir),
+                         [os.path.basename(before['file'])])
+
+    def test_new_upload_when_complete(self):
+        """A complete file sent again with another size is replaced"""
+        self.send('A' * 25, 9, [0, 1, 2])
+        old_file = self.entry()['file']
+        data = 'b' * 15
+        self.send(data, 8, [1, 0])
+        entry = self.entry()
+        self.assertTrue(entry['complete'])
+        self.assertEqual(open(entry['file'], 'rb').read(), data)
+        self.assertFalse(os.path.exists(old_file))
+        self.assertEqual(uph.list_uploaded_files(self.upload_dir),
+                         [os.path.basename(entry['file'])])
+
+    def test_inconsistent_chunks(self):
+        """Chunks which cannot make up the file are rejected"""
+        rv = uph._store_chunk_inplace(self.upload_dir, 'data.csv', 0, 5, 8,
+                                      15, StringIO('x' * 8))
+        self.assertEqual(rv[1], 400)
+
+    def test_invalid_parameters(self):
+        """Chunks with parameters which are not valid integers are rejected"""
+        for params in [('x', 2, 8, 15), (0, 2, '', 15), (0, 2, 8, None),
+                       (-1, 2, 8, 15), (0, 1, 8, -8)]:
+            rv = uph._store_chunk_inplace(self.upload_dir, 'data.csv',
+                                          *(params + (StringIO('x'), )))
+            self.assertEqual(rv[1], 400)
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+
+class PossessionProofTest(InvenioTestCase):
+
+    sub_id = '4fa21e3c-1111-11e3-8000-000000000007'
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (uph.CFG_SIMPLESTORE_UPLOAD_FOLDER,
+                      blobstore.CFG_SIMPLESTORE_BLOB_FOLDER)
+        uph.CFG_SIMPLESTORE_UPLOAD_FOLDER = os.path.join(self.folder, 'up')
+        blobstore.CFG_SIMPLESTORE_BLOB_FOLDER = os.path.join(self.folder, 'bl')
+        self.data = ''.join(chr(i % 251) for i in range(20000))
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        source = os.path.join(self.folder, 'source')
+        with open(source, 'wb') as fp:
+            fp.write(self.data)
+        blobstore.store(source, self.sha256)
+
+    def tearDown(self):
+        (uph.CFG_SIMPLESTORE_UPLOAD_FOLDER,
+         blobstore.CFG_SIMPLESTORE_BLOB_FOLDER) = self.saved
+        shutil.rmtree(self.folder)
+
+    def precheck(self, **form):
+        form = dict(name='data.bin', sha256=self.sha256,
+                    size=len(self.data), **form)
+        request = Request(EnvironBuilder(method='POST', data=form)
+                          .get_environ())
+        rv = uph.upload_precheck(request, self.sub_id)
+        if isinstance(rv, tuple):
+            return rv
+        return json.loads(rv.data)
+
+    def proof(self, ranges):
+        return hashlib.sha256(''.join(self.data[start:end]
+                                      for start, end in ranges)).hexdigest()
+
+    def test_nonce(self):
+        """Nonces are only valid for what they were issued for, and not long"""
+        nonce = uph._new_nonce(self.sub_id, self.sha256, 10)
+        self.assertTrue(uph._valid_nonce(nonce, self.sub_id, self.sha256, 10))
+        self.assertFalse(uph._valid_nonce(nonce, self.sub_id, self.sha256, 11))
+        self.assertFalse(uph._valid_nonce(nonce, 'other', self.sha256, 10))
+        self.assertFalse(uph._valid_nonce(nonce[:-1] + 'x', self.sub_id,
+                                          self.sha256, 10))
+        self.assertFalse(uph._valid_nonce('garbage', self.sub_id,
+                                          self.sha256, 10))
+        issued = '%x' % int(time.time() - uph.PROOF_TIMEOUT - 1)
+        expired = '%s.00.%s' % (issued, uph._sign(self.sub_id, self.sha256,
+                                                  10, issued, '00'))
+        self.assertFalse(uph._valid_nonce(expired, self.sub_id, self.sha256,
+                                          10))
+
+    def test_ranges(self):
+        """Proof ranges lie within the file and depend on the nonce"""
+        size = len(self.data)
+        nonce = uph._new_nonce(self.sub_id, self.sha256, size)
+        ranges = uph._proof_ranges(self.sub_id, self.sha256, size, nonce)
+        self.assertEqual(len(ranges), uph.PROOF_RANGES)
+        for start, end in ranges:
+            self.assertTrue(0 <= start < end <= size)
+            self.assertTrue(end - start <= uph.PROOF_RANGE_SIZE)
+        self.assertEqual(ranges, uph._proof_ranges(self.sub_id, self.sha256,
+                                                   size, nonce))
+        other = uph._new_nonce(self.sub_id, self.sha256, size)
+        self.assertNotEqual(ranges, uph._proof_ranges(self.sub_id,
+                                                      self.sha256, size,
+                                                      other))
+        self.assertEqual(uph._proof_ranges(self.sub_id, self.sha256, 0,
+                                           nonce), [])
+
+    def test_precheck(self):
+        """Known content is only attached with a proof of possession"""
+        challenge = self.precheck()
+        self.assertFalse(challenge['exists'])
+        nonce, ranges = challenge['nonce'], challenge['ranges']
+        self.assertFalse(self.precheck(nonce=nonce)['exists'])
+        self.assertFalse(self.precheck(nonce=nonce,
+                                       proof=self.sha256)['exists'])
+        self.assertEqual(self.precheck(nonce='1.2.3', proof=self.sha256)[1],
+                         400)
+        rv = self.precheck(nonce=nonce, proof=self.proof(ranges))
+        self.assertTrue(rv['exists'])
+        entry = manifest.read_manifest(uph.get_upload_dir(self.sub_id))[
+            'files'][rv['filename']]
+        self.assertTrue(entry['complete'])
+        self.assertEqual(open(entry['file'], 'rb').read(), self.data)
+
+
+class GetFileTest(InvenioTestCase):
+
+    sub_id = '4fa21e3c-1111-11e3-8000-000000000012'
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (uph.CFG_SIMPLESTORE_UPLOAD_FOLDER,
+                      uph.CFG_SIMPLESTORE_DOWNLOAD_ACCEL)
+        uph.CFG_SIMPLESTORE_UPLOAD_FOLDER = self.folder
+        uph.CFG_SIMPLESTORE_DOWNLOAD_ACCEL = None
+        self.data = ''.join(chr(i % 256) for i in range(1000))
+        upload_dir = uph._prepare_upload_dir(self.sub_id)
+        file_path = os.path.join(upload_dir, 'stored-uuid')
+        with open(file_path, 'wb') as fp:
+            fp.write(self.data)
+        manifest.record_file(upload_dir, 'data.bin', 'data.bin', file_path,
+                             len(self.data))
+
+    def tearDown(self):
+        (uph.CFG_SIMPLESTORE_UPLOAD_FOLDER,
+         uph.CFG_SIMPLESTORE_DOWNLOAD_ACCEL) = self.saved
+        shutil.rmtree(self.folder)
+
+    def get(self, **headers):
+        request = Request(EnvironBuilder(
+            query_string={'filename': 'data.bin'},
+            headers=headers).get_environ())
+        rv = uph.get_file(request, self.sub_id)
+        body = ''.join(rv.response) if rv.status_code != 304 else ''
+        return rv.status_code, rv.headers, body
+
+    def test_whole_file(self):
+        """The file is sent whole without a Range header"""
+        status, headers, body = self.get()
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(headers['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        """Byte ranges are answered with partial content"""
+        status, headers, body = self.get(Range='bytes=10-19')
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.data[10:20])
+        self.assertEqual(headers['Content-Range'], 'bytes 10-19/1000')
+        self.assertEqual(self.get(Range='bytes=-5')[2], self.data[-5:])
+
+    def test_unsatisfiable_range(self):
+        """Ranges beyond the end of the file are answered with 416"""
+        status, headers, body = self.get(Range='bytes=1000-')
+        self.assertEqual(status, 416)
+        self.assertEqual(headers['Content-Range'], 'bytes */1000')
+
+    def test_if_range(self):
+        """The whole file is sent if If-Range names another version"""
+        headers = self.get()[1]
+        status, _, body = self.get(Range='bytes=0-1',
+                                   **{'If-Range': headers['ETag']})
+        self.assertEqual((status, body), (206, self.data[:2]))
+        status, _, body = self.get(Range='bytes=0-1',
+                                   **{'If-Range': headers['Last-Modified']})
+        self.assertEqual((status, body), (206, self.data[:2]))
+        status, _, body = self.get(Range='bytes=0-1',
+                                   **{'If-Range': '"other"'})
+        self.assertEqual((status, body), (200, self.data))
+
+    def test_not_modified(self):
+        """A request naming the current version is answered with 304"""
+        etag = self.get()[1]['ETag']
+        self.assertEqual(self.get(**{'If-None-Match': etag})[0], 304)
+
+
+TEST_SUITE = make_test_suite(RecommendedChunkSizeTest, InplaceUploadTest,
+                             PossessionProofTest, GetFileTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)